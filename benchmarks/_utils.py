@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks._utils
+    ~~~~~~~~~~~~~~~~~
+
+    Helpers shared by the benchmarks.
+
+    The benchmarks run what they measure in a child process, so that the peak RSS they report
+    only accounts for it.
+'''
+
+# Import Python Libs
+import sys
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def get_peak_rss_kb(rusage=None):
+    '''
+    The peak RSS, in kilobytes, ``rusage`` reports, defaulting to the current process' one, or
+    ``None`` where it cannot be measured
+    '''
+    if rusage is None:
+        if resource is None:
+            return None
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+    if sys.platform == 'darwin':
+        # Reported in bytes, not kilobytes
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def get_peak_rss_growth_kb(rss_before):
+    '''
+    How much the peak RSS of the current process grew since it was ``rss_before``
+    '''
+    if rss_before is None:
+        return 'n/a'
+    return get_peak_rss_kb() - rss_before
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.depcache
+    ~~~~~~~~~~~~~~~~~~~
+
+    Compare pip-tools' JSON dependency cache against the SQLite one, holding ``--entries`` entries.
+
+    Each backend runs what a hook call does to it: open the cache, look up ``--lookups`` pinned
+    requirements, most of them cached, and add the missing ones::
+
+        python benchmarks/depcache.py --entries 20000
+'''
+
+# Import Python Libs
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Import benchmark Libs
+from _utils import get_peak_rss_kb, get_peak_rss_growth_kb
+
+BACKENDS = ('json', 'sqlite')
+NAMESPACE = 'depcache-linux-py3.7'
+
+
+def get_entries(count):
+    '''
+    ``count`` cache entries, as many projects as versions per project churned
+    '''
+    projects = max(int(count ** 0.5), 1)
+    for idx in range(count):
+        name = 'project{}'.format(idx % projects)
+        version = '1.{}.0'.format(idx // projects)
+        yield name, version, sorted('dependency{}>={}'.format(dep, idx % 7) for dep in range(idx % 5))
+
+
+def populate(backend, cache_dir, entries):
+    if backend == 'json':
+        cache = {}
+        for name, version, dependencies in get_entries(entries):
+            cache.setdefault(name, {})[version] = dependencies
+        with open(os.path.join(cache_dir, '{}.json'.format(NAMESPACE)), 'w') as wfh:
+            json.dump({'__format__': 1, 'dependencies': cache}, wfh, sort_keys=True)
+        return
+    import piptoolscompile.depcache
+    connection = piptoolscompile.depcache.connect(os.path.join(cache_dir, piptoolscompile.depcache.DEPCACHE_DATABASE))
+    connection.execute('BEGIN')
+    connection.executemany(
+        'INSERT INTO dependencies (namespace, name, version, dependencies, last_used) VALUES (?, ?, ?, ?, ?)',
+        ((NAMESPACE, name, version, json.dumps(dependencies), int(time.time()))
+         for name, version, dependencies in get_entries(entries))
+    )
+    connection.execute('COMMIT')
+    connection.close()
+
+
+def run_backend(backend, cache_dir, entries, lookups):
+    from pip._internal.req.constructors import install_req_from_line
+    from piptools.cache import DependencyCache
+    import piptoolscompile.depcache
+
+    # One in ten lookups misses
+    pinned = [
+        (name, version) for idx, (name, version, _) in enumerate(get_entries(entries))
+        if idx % max(entries // lookups, 1) == 0
+    ][:lookups]
+    ireqs = [
+        install_req_from_line('{}=={}'.format(name, version if idx % 10 else version + '.post1'))
+        for idx, (name, version) in enumerate(pinned)
+    ]
+    rss_before = get_peak_rss_kb()
+    start = time.perf_counter()
+    if backend == 'json':
+        cache = DependencyCache(cache_dir)
+        cache._cache_file = os.path.join(cache_dir, '{}.json'.format(NAMESPACE))
+    else:
+        cache = piptoolscompile.depcache.SQLiteDependencyCache(cache_dir, NAMESPACE)
+    misses = 0
+    for ireq in ireqs:
+        if ireq not in cache:
+            misses += 1
+            cache[ireq] = ['dependency0>=1']
+        cache[ireq]
+    duration = time.perf_counter() - start
+    return {
+        'backend': backend,
+        'duration_ms': duration * 1000,
+        'misses': misses,
+        'disk_size_kb': sum(
+            os.path.getsize(os.path.join(cache_dir, fname)) for fname in os.listdir(cache_dir)
+        ) // 1024,
+        'peak_rss_growth_kb': get_peak_rss_growth_kb(rss_before),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=20000, help='Number of entries in the cache')
+    parser.add_argument('--lookups', type=int, default=200, help='Number of pinned requirements looked up')
+    parser.add_argument('--backend', choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument('--cache-dir', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.backend:
+        print(json.dumps(run_backend(options.backend, options.cache_dir, options.entries, options.lookups)))
+        return
+
+    print('{} entries, {} lookups'.format(options.entries, options.lookups))
+    print('{:<8} {:>14} {:>8} {:>16} {:>20}'.format('backend', 'duration (ms)', 'misses', 'disk size (KB)', 'peak RSS growth (KB)'))
+    for backend in BACKENDS:
+        cache_dir = tempfile.mkdtemp(prefix='depcache-benchmark-')
+        try:
+            populate(backend, cache_dir, options.entries)
+            output = subprocess.check_output([
+                sys.executable, __file__,
+                '--backend={}'.format(backend),
+                '--cache-dir={}'.format(cache_dir),
+                '--entries={}'.format(options.entries),
+                '--lookups={}'.format(options.lookups),
+            ])
+        finally:
+            shutil.rmtree(cache_dir)
+        result = json.loads(output.decode('utf-8'))
+        print('{backend:<8} {duration_ms:>14.2f} {misses:>8} {disk_size_kb:>16} {peak_rss_growth_kb:>20}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
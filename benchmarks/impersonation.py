@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.impersonation
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare the cost of the impersonation patches against the ``MagicMock`` based ones they replaced.
+
+    Each engine evaluates the environment markers and computes the supported wheel tags the same way
+    pip does while resolving::
+
+        python benchmarks/impersonation.py --calls 100000
+'''
+
+# Import Python Libs
+import sys
+import json
+import time
+import argparse
+import subprocess
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import benchmark Libs
+from _utils import get_peak_rss_kb, get_peak_rss_growth_kb
+
+ENGINES = ('plain', 'magicmock')
+MARKERS = (
+    'python_version < "3.8"',
+    'platform_machine == "x86_64" and platform_system == "Linux"',
+    'sys_platform == "win32" or os_name == "nt"',
+    'platform_release >= "4" and platform_version != ""',
+)
+
+
+class MagicMockImpersonation(object):
+    '''
+    Re-apply the impersonation the way it used to be done, every patched function behind a
+    recording ``MagicMock`` and every value behind a ``PropertyMock``.
+    '''
+
+    def __init__(self, impersonation):
+        self._impersonation = impersonation
+        self._patches = []
+
+    def __enter__(self):
+        self._impersonation.__enter__()
+        for patch in self._impersonation._patches:
+            target = patch.getter()
+            current = getattr(target, patch.attribute)
+            if callable(current) and not isinstance(current, type):
+                legacy = mock.patch.object(target, patch.attribute, wraps=current)
+            else:
+                legacy = mock.patch.object(target, patch.attribute,
+                                           new_callable=mock.PropertyMock(return_value=current))
+            legacy.__enter__()
+            self._patches.append(legacy)
+        return self
+
+    def __exit__(self, *args):
+        while self._patches:
+            self._patches.pop().__exit__(*args)
+        self._impersonation.__exit__(*args)
+
+
+def run_engine(engine, platform, py_version, calls):
+    import piptoolscompile.hacks
+    from pip._vendor.packaging.markers import Marker
+    import pip._internal.index
+
+    impersonation = piptoolscompile.hacks.IMPERSONATIONS[platform](py_version, platform)
+    if engine == 'magicmock':
+        impersonation = MagicMockImpersonation(impersonation)
+    markers = [Marker(marker) for marker in MARKERS]
+    rss_before = get_peak_rss_kb()
+    with impersonation:
+        start = time.perf_counter()
+        for _ in range(calls):
+            for marker in markers:
+                marker.evaluate()
+        markers_duration = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(calls // 100 or 1):
+            pip._internal.index.get_supported()
+        tags_duration = time.perf_counter() - start
+    return {
+        'engine': engine,
+        'marker_evaluation_us': markers_duration / (calls * len(markers)) * 1e6,
+        'get_supported_us': tags_duration / (calls // 100 or 1) * 1e6,
+        'peak_rss_growth_kb': get_peak_rss_growth_kb(rss_before),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=100000, help='Number of times each marker gets evaluated')
+    parser.add_argument('--platform', default='linux', choices=('linux', 'windows', 'darwin'))
+    parser.add_argument('--py-version', default='3.7')
+    parser.add_argument('--engine', choices=ENGINES, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.engine:
+        print(json.dumps(run_engine(options.engine, options.platform, options.py_version, options.calls)))
+        return
+
+    print('{:<10} {:>22} {:>18} {:>20}'.format('engine', 'marker evaluation (us)', 'get_supported (us)', 'peak RSS growth (KB)'))
+    for engine in ENGINES:
+        output = subprocess.check_output([
+            sys.executable, __file__,
+            '--engine={}'.format(engine),
+            '--calls={}'.format(options.calls),
+            '--platform={}'.format(options.platform),
+            '--py-version={}'.format(options.py_version),
+        ])
+        result = json.loads(output.decode('utf-8'))
+        print('{engine:<10} {marker_evaluation_us:>22.2f} {get_supported_us:>18.2f} {peak_rss_growth_kb:>20}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.offline_compile
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Time whole ``pip-tools-compile`` runs, without touching PyPI.
+
+    The packages below are stand-ins for the boto3, pyobjc and pywin32 dependency trees the tests
+    compile, carrying the same requirements, python requirements and wheel tags, but no code. They
+    get built into wheels and sdists, and served from a local simple index. Every input is compiled
+    for every platform and python version, first with empty caches, then ``--rounds`` times with
+    the caches the first compile filled::
+
+        python benchmarks/offline_compile.py --rounds 3
+        python benchmarks/offline_compile.py --compare benchmarks/results/20200101T000000Z.json
+
+    The results are stored as JSON under ``benchmarks/results/``, to compare runs over time.
+'''
+
+# Import Python Libs
+import io
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import textwrap
+import threading
+import statistics
+import subprocess
+import socketserver
+import urllib.parse
+import http.server
+
+# Import benchmark Libs
+from _utils import get_peak_rss_kb
+
+BENCHMARKS_DIR = os.path.abspath(os.path.dirname(__file__))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+PLATFORMS = ('linux', 'windows', 'darwin')
+PY_VERSIONS = ('3.6', '3.7')
+
+ANY = ('py2.py3-none-any',)
+MACOS = tuple('cp{0}-cp{0}m-macosx_10_9_x86_64'.format(version) for version in ('36', '37'))
+WINDOWS = tuple('cp{0}-cp{0}m-{1}'.format(version, arch) for version in ('36', '37') for arch in ('win32', 'win_amd64'))
+
+# (name, versions, requirements, python requirement, wheel tags or None for an sdist)
+PACKAGES = (
+    ('boto3', ('1.9.121', '1.9.122', '1.9.123', '1.9.124'), (
+        'botocore (<1.13.0,>=1.12.121)',
+        'jmespath (<1.0.0,>=0.7.1)',
+        's3transfer (<0.3.0,>=0.2.0)',
+    ), None, ANY),
+    ('botocore', ('1.12.121', '1.12.122', '1.12.123', '1.12.124', '1.12.125'), (
+        'jmespath (<1.0.0,>=0.7.1)',
+        'docutils (>=0.10)',
+        'python-dateutil (<3.0.0,>=2.1) ; python_version>="2.7"',
+        'urllib3 (<1.25,>=1.20) ; python_version>="3.4"',
+    ), None, ANY),
+    ('s3transfer', ('0.1.13', '0.2.0', '0.2.1'), (
+        'botocore (<2.0.0,>=1.12.36)',
+        'futures (<4.0.0,>=2.2.0) ; python_version=="2.6" or python_version=="2.7"',
+    ), None, ANY),
+    ('futures', ('3.1.1', '3.2.0'), (), '>=2.6, <3', ('py2-none-any',)),
+    ('jmespath', ('0.9.3', '0.9.4'), (), None, ANY),
+    ('docutils', ('0.13.1', '0.14', '0.15'), (), None, ('py3-none-any',)),
+    ('python-dateutil', ('2.7.5', '2.8.0'), ('six (>=1.5)',), '>=2.7, !=3.0.*, !=3.1.*, !=3.2.*', ANY),
+    ('six', ('1.11.0', '1.12.0', '1.13.0'), (), None, ANY),
+    ('urllib3', ('1.23', '1.24.1', '1.24.2'), (), None, ANY),
+    ('pyobjc', ('5.2',), (
+        'pyobjc-core==5.2',
+        'pyobjc-framework-Cocoa==5.2',
+        'pyobjc-framework-Quartz==5.2',
+    ), '>=3.6', None),
+    ('pyobjc-core', ('5.2',), (), '>=3.6', MACOS),
+    ('pyobjc-framework-Cocoa', ('5.2',), ('pyobjc-core (>=5.2)',), '>=3.6', MACOS),
+    ('pyobjc-framework-Quartz', ('5.2',), ('pyobjc-core (>=5.2)', 'pyobjc-framework-Cocoa (>=5.2)'), '>=3.6', MACOS),
+    ('pywin32', ('223', '224'), (), None, WINDOWS),
+)
+
+INPUTS = {
+    'boto3': textwrap.dedent('''\
+        boto3==1.9.123
+        botocore<=1.12.124
+        futures<=3.1.1; python_version < "3"
+        six<=1.12.0
+        urllib3<=1.24.1
+        '''),
+    'pyobjc': 'pyobjc==5.2; sys_platform == "darwin"\n',
+    'pywin32': 'pywin32==224; sys_platform == "win32"\n',
+}
+
+
+def _normalize(name):
+    return name.lower().replace('_', '-').replace('.', '-')
+
+
+def _metadata(name, version, requirements, requires_python):
+    lines = ['Metadata-Version: 2.1', 'Name: {}'.format(name), 'Version: {}'.format(version)]
+    if requires_python:
+        lines.append('Requires-Python: {}'.format(requires_python))
+    lines.extend('Requires-Dist: {}'.format(requirement) for requirement in requirements)
+    return '\n'.join(lines) + '\n'
+
+
+def build_wheel(dest_dir, name, version, requirements, requires_python, tag):
+    dist_name = name.replace('-', '_')
+    dist_info = '{}-{}.dist-info'.format(dist_name, version)
+    files = [
+        ('{}.py'.format(dist_name.lower()), ''),
+        ('{}/METADATA'.format(dist_info), _metadata(name, version, requirements, requires_python)),
+        ('{}/WHEEL'.format(dist_info), 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {}\n'.format(tag)),
+    ]
+    record = []
+    for path, contents in files:
+        digest = base64.urlsafe_b64encode(hashlib.sha256(contents.encode('utf-8')).digest()).rstrip(b'=')
+        record.append('{},sha256={},{}'.format(path, digest.decode('ascii'), len(contents)))
+    record.append('{}/RECORD,,'.format(dist_info))
+    files.append(('{}/RECORD'.format(dist_info), '\n'.join(record) + '\n'))
+    path = os.path.join(dest_dir, '{}-{}-{}.whl'.format(dist_name, version, tag))
+    with zipfile.ZipFile(path, 'w') as wheel:
+        for member, contents in files:
+            wheel.writestr(member, contents)
+    return path
+
+
+def build_sdist(dest_dir, name, version, requirements, requires_python):
+    root = '{}-{}'.format(name, version)
+    install_requires = [requirement.replace(' (', '').replace(')', '') for requirement in requirements]
+    files = [
+        ('PKG-INFO', _metadata(name, version, requirements, requires_python)),
+        ('setup.py', textwrap.dedent('''\
+            from setuptools import setup
+            setup(name={!r}, version={!r}, python_requires={!r}, install_requires={!r}, py_modules=[])
+            ''').format(name, version, requires_python, install_requires)),
+    ]
+    path = os.path.join(dest_dir, '{}.tar.gz'.format(root))
+    with tarfile.open(path, 'w:gz') as sdist:
+        for member, contents in files:
+            data = contents.encode('utf-8')
+            info = tarfile.TarInfo('{}/{}'.format(root, member))
+            info.size = len(data)
+            sdist.addfile(info, io.BytesIO(data))
+    return path
+
+
+def build_index(index_dir):
+    '''
+    Build the stand-in packages, and the PEP 503 simple index pages pointing at them
+    '''
+    packages_dir = os.path.join(index_dir, 'packages')
+    os.makedirs(packages_dir)
+    for name, versions, requirements, requires_python, tags in PACKAGES:
+        links = []
+        for version in versions:
+            if tags is None:
+                paths = [build_sdist(packages_dir, name, version, requirements, requires_python)]
+            else:
+                paths = [build_wheel(packages_dir, name, version, requirements, requires_python, tag) for tag in tags]
+            for path in paths:
+                with open(path, 'rb') as rfh:
+                    digest = hashlib.sha256(rfh.read()).hexdigest()
+                attributes = ''
+                if requires_python:
+                    attributes = ' data-requires-python="{}"'.format(requires_python.replace('<', '&lt;').replace('>', '&gt;'))
+                links.append('<a href="../../packages/{0}#sha256={1}"{2}>{0}</a><br/>'.format(
+                    os.path.basename(path), digest, attributes
+                ))
+        project_dir = os.path.join(index_dir, 'simple', _normalize(name))
+        os.makedirs(project_dir)
+        with open(os.path.join(project_dir, 'index.html'), 'w') as wfh:
+            wfh.write('<!DOCTYPE html>\n<html><body>\n{}\n</body></html>\n'.format('\n'.join(links)))
+
+
+class IndexRequestHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    Serve the files under the server's ``index_dir``
+    '''
+
+    def translate_path(self, path):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        parts = [part for part in path.split('/') if part not in ('', '.', '..')]
+        return os.path.join(self.server.index_dir, *parts)
+
+    def log_message(self, *args):
+        pass
+
+
+class IndexServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, index_dir):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0), IndexRequestHandler)
+        self.index_dir = index_dir
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/simple/'.format(self.server_address[1])
+
+
+def run_compile(input_file, platform, py_version, index_url, cache_dir):
+    '''
+    Compile ``input_file`` in its own process. Returns the duration, in seconds, and the peak RSS,
+    in kilobytes.
+    '''
+    environ = {key: value for key, value in os.environ.items() if not key.startswith('PIP_')}
+    environ['PIP_CACHE_DIR'] = os.path.join(cache_dir, 'pip')
+    environ['PIP_DISABLE_PIP_VERSION_CHECK'] = '1'
+    cmdline = [
+        sys.executable, '-m', 'piptoolscompile.cli',
+        '--platform={}'.format(platform),
+        '--py-version={}'.format(py_version),
+        '--force',
+        input_file,
+        '--index-url={}'.format(index_url),
+        '--cache-dir={}'.format(os.path.join(cache_dir, 'pip-tools')),
+    ]
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmdline, stdout=output, stderr=subprocess.STDOUT, env=environ)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        duration = time.perf_counter() - start
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if proc.returncode != 0:
+            output.seek(0)
+            raise RuntimeError('Failed to compile {} for {} py{}:\n{}'.format(
+                input_file, platform, py_version, output.read().decode('utf-8', 'replace')
+            ))
+    return duration, get_peak_rss_kb(rusage)
+
+
+def time_impersonation_setup(platform, py_version, iterations):
+    '''
+    Return how long, in microseconds, entering and exiting the impersonation takes
+    '''
+    import piptoolscompile.hacks
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with piptoolscompile.hacks.IMPERSONATIONS[platform](py_version, platform):
+            pass
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    import pip
+    import pkg_resources
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': get_commit(),
+        'python': sys.version.split()[0],
+        'pip': pip.__version__,
+        'pip-tools': pkg_resources.get_distribution('pip-tools').version,
+        'rounds': options.rounds,
+        'impersonation_setup_us': {},
+        'compiles': [],
+    }
+    work_dir = tempfile.mkdtemp(prefix='pip-tools-compile-benchmark-')
+    try:
+        index_dir = os.path.join(work_dir, 'index')
+        build_index(index_dir)
+        server = IndexServer(index_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            for platform in options.platforms:
+                for py_version in options.py_versions:
+                    target = '{}-py{}'.format(platform, py_version)
+                    results['impersonation_setup_us'][target] = time_impersonation_setup(
+                        platform, py_version, options.iterations
+                    )
+                    for name in options.inputs:
+                        input_dir = os.path.join(work_dir, 'inputs', target)
+                        if not os.path.isdir(input_dir):
+                            os.makedirs(input_dir)
+                        input_file = os.path.join(input_dir, '{}.in'.format(name))
+                        with open(input_file, 'w') as wfh:
+                            wfh.write(INPUTS[name])
+                        # Empty caches for the cold compile, which then fills them for the warm ones
+                        cache_dir = os.path.join(work_dir, 'cache', target, name)
+                        cold, cold_rss = run_compile(input_file, platform, py_version, server.url, cache_dir)
+                        warm = []
+                        warm_rss = 0
+                        for _ in range(options.rounds):
+                            duration, peak_rss = run_compile(input_file, platform, py_version, server.url, cache_dir)
+                            warm.append(duration)
+                            warm_rss = max(warm_rss, peak_rss)
+                        results['compiles'].append({
+                            'input': name,
+                            'platform': platform,
+                            'py_version': py_version,
+                            'cold_s': cold,
+                            'cold_peak_rss_kb': cold_rss,
+                            'warm_s': warm,
+                            'warm_median_s': statistics.median(warm) if warm else None,
+                            'warm_peak_rss_kb': warm_rss or None,
+                        })
+                        print('{:<8} {:<16} cold {:>7.2f}s {:>8} KB   warm {:>7}s {:>8} KB'.format(
+                            name, target, cold, cold_rss,
+                            '{:.2f}'.format(statistics.median(warm)) if warm else '-', warm_rss or '-'
+                        ))
+                        sys.stdout.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(previous, current):
+    def key(entry):
+        return (entry['input'], entry['platform'], entry['py_version'])
+
+    previous_compiles = {key(entry): entry for entry in previous['compiles']}
+    print('\nCompared to {} ({})'.format(previous['timestamp'], previous.get('commit') or 'unknown commit'))
+    print('{:<8} {:<16} {:>10} {:>10} {:>10}'.format('input', 'target', 'cold', 'warm', 'peak RSS'))
+    for entry in current['compiles']:
+        before = previous_compiles.get(key(entry))
+        if before is None:
+            continue
+
+        def ratio(field):
+            if not before.get(field) or not entry.get(field):
+                return '-'
+            return '{:+.1%}'.format(entry[field] / before[field] - 1)
+
+        print('{:<8} {:<16} {:>10} {:>10} {:>10}'.format(
+            entry['input'], '{}-py{}'.format(entry['platform'], entry['py_version']),
+            ratio('cold_s'), ratio('warm_median_s'), ratio('cold_peak_rss_kb')
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--platform', dest='platforms', action='append', choices=PLATFORMS)
+    parser.add_argument('--py-version', dest='py_versions', action='append')
+    parser.add_argument('--input', dest='inputs', action='append', choices=sorted(INPUTS))
+    parser.add_argument('--rounds', type=int, default=3, help='Number of warm cache compiles')
+    parser.add_argument('--iterations', type=int, default=1000, help='Number of impersonation setups timed')
+    parser.add_argument('--output', help='Where to store the JSON results. Default: benchmarks/results/<timestamp>.json')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    options = parser.parse_args()
+    options.platforms = options.platforms or PLATFORMS
+    options.py_versions = options.py_versions or PY_VERSIONS
+    options.inputs = options.inputs or sorted(INPUTS)
+
+    results = run(options)
+
+    output = options.output
+    if not output:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '{}.json'.format(results['timestamp'].replace('-', '').replace(':', '')))
+    with open(output, 'w') as wfh:
+        json.dump(results, wfh, indent=2, sort_keys=True)
+    print('Results stored in {}'.format(output))
+
+    if options.compare:
+        with open(options.compare) as rfh:
+            compare(json.load(rfh), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.supported_tags
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Time pip's wheel candidate evaluation against the plain supported tags list and against the
+    memoized ``SupportedTags`` the impersonations serve, for a release shipping as many wheels as
+    numpy or grpcio do::
+
+        python benchmarks/supported_tags.py --releases 50
+
+    The darwin impersonation, the default, supports the most tags, one per macOS release and
+    architecture, which is where ranking the supported wheels costs the most. The linux one only
+    supports ``linux2`` wheels, which no index serves.
+'''
+
+# Import Python Libs
+import time
+import argparse
+
+PYTHON_TAGS = ('cp35', 'cp36', 'cp37', 'cp38', 'cp39')
+PLATFORM_TAGS = (
+    'manylinux1_x86_64', 'manylinux1_i686', 'manylinux2010_x86_64', 'manylinux2010_i686',
+    'manylinux2014_aarch64', 'manylinux2014_ppc64le', 'manylinux2014_s390x',
+    'macosx_10_9_x86_64', 'macosx_10_9_intel', 'macosx_11_0_arm64', 'win32', 'win_amd64',
+)
+
+
+def get_wheels(releases):
+    from pip._internal.wheel import Wheel
+    wheels = []
+    for release in range(releases):
+        for python_tag in PYTHON_TAGS:
+            abi_tag = python_tag + ('m' if python_tag < 'cp38' else '')
+            for platform_tag in PLATFORM_TAGS:
+                wheels.append(Wheel('numpy-1.{}.0-{}-{}-{}.whl'.format(release, python_tag, abi_tag, platform_tag)))
+    return wheels
+
+
+def evaluate(wheels, valid_tags):
+    from pip._internal.index import CandidateEvaluator
+    evaluator = CandidateEvaluator(valid_tags=valid_tags)
+    start = time.perf_counter()
+    supported = [wheel for wheel in wheels if evaluator.is_wheel_supported(wheel)]
+    priorities = [wheel.support_index_min(valid_tags) for wheel in supported]
+    return time.perf_counter() - start, len(supported), priorities
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--releases', type=int, default=50)
+    parser.add_argument('--platform', default='darwin', choices=('windows', 'darwin'))
+    parser.add_argument('--py-version', default='3.7')
+    options = parser.parse_args()
+
+    import piptoolscompile.hacks
+    from pip._internal.wheel import Wheel
+    real_wheel_supported = Wheel.supported
+    wheels = get_wheels(options.releases)
+    impersonation = piptoolscompile.hacks.IMPERSONATIONS[options.platform](options.py_version, options.platform)
+    with impersonation:
+        tags = impersonation.get_supported()
+        # The tags list and Wheel.supported, as pip computes them when not impersonating a target
+        with piptoolscompile.hacks.mock.patch('pip._internal.wheel.Wheel.supported',
+                                              new=real_wheel_supported):
+            list_duration, list_supported, list_priorities = evaluate(wheels, list(tags))
+        indexed_duration, indexed_supported, indexed_priorities = evaluate(wheels, tags)
+    assert (list_supported, list_priorities) == (indexed_supported, indexed_priorities)
+    if not indexed_supported:
+        parser.error('None of the wheels is supported by the {} impersonation'.format(options.platform))
+    print('{} wheel links, {} supported tags, {} supported wheels'.format(len(wheels), len(tags), indexed_supported))
+    print('{:<15} {:>10.2f} ms'.format('list', list_duration * 1000))
+    print('{:<15} {:>10.2f} ms'.format('SupportedTags', indexed_duration * 1000))
+
+
+if __name__ == '__main__':
+    main()
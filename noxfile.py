@@ -38,3 +38,17 @@ def tests_system(session):
     session.run('python', '-m', 'pip', 'install', '-e', '.')
     session.run('python', '-m', 'pip', 'install', 'pytest')
     session.run('python', '-m', 'pytest', '-ra', '-s', '-vv', 'tests', *session.posargs)
+
+
+@nox.session(python=PYTHON_VERSIONS)
+def benchmarks(session):
+    session.run('python', '-m', 'pip', 'install', '.')
+    session.run('python', 'benchmarks/impersonation.py', *session.posargs)
+    session.run('python', 'benchmarks/supported_tags.py')
+    session.run('python', 'benchmarks/depcache.py')
+
+
+@nox.session(python=PYTHON_VERSIONS, name='benchmarks-compile')
+def benchmarks_compile(session):
+    session.run('python', '-m', 'pip', 'install', '.')
+    session.run('python', 'benchmarks/offline_compile.py', *session.posargs)
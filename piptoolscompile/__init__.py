@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile
+    ~~~~~~~~~~~~~~~
+
+    Nothing imported from here may import pip or pip-tools, ``pip-tools-compile`` only imports those
+    once it knows it has something to compile.
+'''
+
+# Import Python Libs
+import sys
+from collections import namedtuple
+
+version_info = namedtuple('version_info', ['major', 'minor', 'micro', 'releaselevel', 'serial'])
+
+
+def get_python_version_info(python_version):
+    '''
+    Return the ``sys.version_info`` to impersonate for ``python_version``, ie, ``3.7``, the parts
+    which are not passed taken from the running python
+    '''
+    parts = [int(part) for part in python_version.split('.') if part.isdigit()]
+    python_version_info = list(sys.version_info)
+    for idx, part in enumerate(parts):
+        python_version_info[idx] = part
+    return version_info(*python_version_info)
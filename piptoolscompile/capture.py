@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.capture
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Bounded memory buffers for the captured log and output.
+
+    What gets written is kept in memory up to a size threshold, then moved to an anonymous
+    temporary file, so that long batch runs, and chatty DEBUG logs, use a constant amount of
+    memory. Nothing gets dropped, the captured output is only useful when it is complete.
+'''
+
+# Import Python Libs
+import io
+import tempfile
+
+# How many characters to keep in memory before spilling to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+# How many characters to copy at a time
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledBuffer(io.TextIOBase):
+    '''
+    Text stream kept in memory until it grows past ``max_size`` characters, and in a temporary
+    file afterwards
+    '''
+
+    def __init__(self, max_size=SPOOL_MAX_SIZE):
+        super(SpooledBuffer, self).__init__()
+        self._max_size = max_size
+        self._buffer = io.StringIO()
+        self._size = 0
+        self._spilled = False
+
+    @property
+    def spilled(self):
+        return self._spilled
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def write(self, data):
+        written = self._buffer.write(data)
+        self._size += written
+        if not self._spilled and self._size > self._max_size:
+            self._spill()
+        return written
+
+    def _spill(self):
+        spilled = io.TextIOWrapper(tempfile.TemporaryFile(), encoding='utf-8', errors='replace', newline='')
+        spilled.write(self._buffer.getvalue())
+        self._buffer = spilled
+        self._spilled = True
+
+    def flush(self):
+        self._buffer.flush()
+
+    def reset(self):
+        '''
+        Drop everything written so far, releasing the memory or temporary file holding it
+        '''
+        self._buffer.close()
+        self._buffer = io.StringIO()
+        self._size = 0
+        self._spilled = False
+
+    def copy_to(self, stream):
+        '''
+        Write everything written so far to ``stream``, a chunk at a time
+        '''
+        self._buffer.flush()
+        self._buffer.seek(0)
+        try:
+            while True:
+                chunk = self._buffer.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                stream.write(chunk)
+        finally:
+            self._buffer.seek(0, io.SEEK_END)
+
+    def getvalue(self):
+        contents = io.StringIO()
+        self.copy_to(contents)
+        return contents.getvalue()
+
+    def close(self):
+        self._buffer.close()
+        super(SpooledBuffer, self).close()
@@ -8,87 +8,153 @@
 '''
 
 # Import Python Libs
-import io
 import os
 import re
 import sys
+import json
+import shlex
+import shutil
+import hashlib
+import contextlib
 import logging
 import argparse
 import platform
-import tempfile
-import textwrap
 import traceback
-try:
-    from unittest import mock
-except ImportError:
-    import mock
+
+# Import pip-tools-compile Libs
+# pip, pip-tools, and every module importing them, only get imported once there's something to compile
+import piptoolscompile
+import piptoolscompile.utils
+import piptoolscompile.capture
 
 CAPTURE_OUTPUT = os.environ.get('CAPTURE_OUTPUT', '1') == '1'
 
-LOG_STREAM = io.StringIO()
+# The log of the requirements file being compiled, written next to it when compiling fails
+LOG_STREAM = piptoolscompile.capture.SpooledBuffer()
 logging.basicConfig(
     level=logging.DEBUG,
     stream=LOG_STREAM,
     datefmt='%H:%M:%S',
     format='%(asctime)s,%(msecs)03.0f [%(name)-5s:%(lineno)-4d][%(levelname)-8s] %(message)s')
 
-# Import pip-tools Libs
-# Keep a reference to the original DependencyCache class
-from piptools.cache import DependencyCache
-
-# Import pip libs
-# We don't need Py2 vs Py3 encode/decode issues from pip
-import pip._internal.utils.misc
+# Keep a reference to the real sys.version_info, the impersonations patch it
 real_version_info = sys.version_info
 
 log = logging.getLogger(os.path.basename(__file__))
 
+PLATFORMS = ('windows', 'darwin', 'linux')
+
+# The state shared between the compiles of long lived processes, worker processes and the daemon,
+# kept for their whole lifetime
+_WORKER_SHARED_STATE = None
+
+# Bump whenever what goes into the fingerprint changes
+FINGERPRINT_VERSION = 2
+FINGERPRINT_PREFIX = '# pip-tools-compile fingerprint: '
+# pip-compile arguments which always require resolving again, even if the inputs did not change
+FORCE_COMPILE_ARGS = ('-U', '--upgrade', '-P', '--upgrade-package', '--rebuild')
+SIZE_RE = re.compile(r'^(?P<size>\d+(\.\d+)?)(?P<unit>[KMG]?)B?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
 
 def tweak_piptools_depcache_filename(version_info, platform, *args, **kwargs):
-    depcache = DependencyCache(*args, **kwargs)
-    cache_file = os.path.join(os.path.dirname(depcache._cache_file),
-                              'depcache-{}-py{}.{}.json'.format(platform, *version_info))
-    log.info('Tweaking the pip-tools depcache file to: %s', cache_file)
-    depcache._cache_file = cache_file
-    return depcache
+    import piptoolscompile.depcache
+    return piptoolscompile.depcache.get_dependency_cache(version_info, platform, *args, **kwargs)
 
 
 class CatureSTDs(object):
+    '''
+    Capture stdout and stderr, to only show them when something fails.
+
+    With ``CAPTURE_OUTPUT=0`` the output goes straight through instead, unless ``replay`` is
+    ``False``, meaning the caller takes care of writing it out.
+    '''
 
-    def __init__(self):
-        self._stdout = io.StringIO()
-        self._stderr = io.StringIO()
-        self._sys_stdout = sys.stdout
-        self._sys_stderr = sys.stderr
+    def __init__(self, replay=True):
+        self._replay = replay
+        self._stdout = piptoolscompile.capture.SpooledBuffer()
+        self._stderr = piptoolscompile.capture.SpooledBuffer()
+        self._sys_stdout = None
+        self._sys_stderr = None
 
     def __enter__(self):
-        sys.stdout = self._stdout
-        sys.stderr = self._stderr
+        if CAPTURE_OUTPUT or not self._replay:
+            self._sys_stdout = sys.stdout
+            self._sys_stderr = sys.stderr
+            sys.stdout = self._stdout
+            sys.stderr = self._stderr
         return self
 
     def __exit__(self, *args):
-        sys.stdout = self._sys_stdout
-        sys.stderr = self._sys_stderr
-        if not CAPTURE_OUTPUT:
-            self._stdout.seek(0)
-            sys.stdout.write(self._stdout.read())
-            self._stderr.seek(0)
-            sys.stderr.write(self._stderr.read())
+        if self._sys_stdout is not None:
+            sys.stdout = self._sys_stdout
+            sys.stderr = self._sys_stderr
+            self._sys_stdout = self._sys_stderr = None
 
     @property
     def stdout(self):
-        self._stdout.seek(0)
-        return self._stdout.read()
+        return self._stdout.getvalue()
 
     @property
     def stderr(self):
-        self._stderr.seek(0)
-        return self._stderr.read()
+        return self._stderr.getvalue()
+
+    def replay(self):
+        '''
+        Write the captured output out
+        '''
+        self._stdout.copy_to(sys.stdout)
+        self._stderr.copy_to(sys.stderr)
+
+    def close(self):
+        self._stdout.close()
+        self._stderr.close()
+
+
+def compile_environment():
+    '''
+    The environment changes in place while pip-compile runs
+    '''
+    try:
+        from unittest import mock
+    except ImportError:
+        import mock
+    return mock.patch('pip._internal.utils.misc.sys.version_info', new=real_version_info)
+
+
+def compile_requirement_file(source, dest, options, unknown_args, transforms=()):
+    '''
+    Compile ``source`` to ``dest``, then run the compiled requirements through the post-processing
+    line ``transforms``.
+
+    pip-compile writes to a copy of ``dest``, which only replaces it, atomically, when the end
+    result differs, so that compiling the same requirements again leaves ``dest`` untouched.
+    '''
+    import piptoolscompile.includes
 
+    if options.include and piptoolscompile.includes.PreprocessedIncludes.current is None:
+        # Not called during a run, preprocess the includes just for this compile
+        with piptoolscompile.includes.PreprocessedIncludes():
+            return compile_requirement_file(source, dest, options, unknown_args, transforms)
 
-def compile_requirement_file(source, dest, options, unknown_args):
     log.info('Compiling requirements to %s', dest)
 
+    compile_dest = piptoolscompile.utils.make_temp_file(dest, suffix='.txt')
+    if os.path.exists(dest):
+        # pip-compile sticks to the existing pins
+        shutil.copy(dest, compile_dest)
+    try:
+        return _compile_requirement_file(source, dest, compile_dest, options, unknown_args, transforms)
+    finally:
+        if os.path.exists(compile_dest):
+            os.unlink(compile_dest)
+
+
+def _compile_requirement_file(source, dest, compile_dest, options, unknown_args, transforms):
+    import piptoolscompile.includes
+    import piptoolscompile.postprocess
+    import piptoolscompile.timings
+
     input_rewrites  = {}
     passthrough_lines = {}
 
@@ -96,91 +162,105 @@ def compile_requirement_file(source, dest, options, unknown_args):
     for regex in options.passthrough_line_from_input:
         regexes.append(re.compile(regex))
 
-    call_args = ['pip-compile', '-o', dest]
+    call_args = ['pip-compile', '-o', compile_dest]
     if unknown_args:
         call_args += unknown_args
+    snapshot = None
+    if options.snapshot is not None:
+        import piptoolscompile.snapshot
+        snapshot = piptoolscompile.snapshot.activate(options.snapshot)
+        missing = len(getattr(snapshot, 'missing', ()))
+        # Every lookup has to go through pip, none can be served from a cache populated beforehand
+        call_args += ['--cache-dir', snapshot.cache_dir]
     if options.include:
+        preprocessed_includes = piptoolscompile.includes.PreprocessedIncludes.current
         includes = []
         for input_file in options.include:
-            out_contents = []
             input_file = input_file.format(py_version=options.py_version)
-            with open(input_file) as rfh:
-                in_contents = rfh.read()
-                for line in in_contents.splitlines():
-                    match_found = False
-                    for regex in regexes:
-                        if match_found:
-                            break
-                        if regex.match(line):
-                            match_found = True
-                            if input_file not in input_rewrites:
-                                temp_reqs_file = tempfile.NamedTemporaryFile(delete=False)
-                                temp_reqs_file.close()
-                                input_rewrites[input_file] = temp_reqs_file.name
-                            if input_file not in passthrough_lines:
-                                passthrough_lines[input_file] = []
-                    if match_found:
-                        passthrough_lines[input_file].append(line)
-                        # Skip this line
-                        continue
-                    out_contents.append(line)
-            if input_file in input_rewrites:
-                with open(input_rewrites[input_file], 'w') as wfh:
-                    for line in out_contents:
-                        wfh.write('{}\n'.format(line))
-                includes.append(input_rewrites[input_file])
-            else:
-                includes.append(input_file)
+            rewriten_file, include_passthrough_lines = preprocessed_includes.get(input_file, regexes)
+            if include_passthrough_lines:
+                input_rewrites[input_file] = rewriten_file
+                passthrough_lines[input_file] = include_passthrough_lines
+            includes.append(rewriten_file)
         call_args += includes
     call_args.append(source)
 
+    index_state = None
+    # Replayed pages are read from disk, and prefetching pages no longer needed would fail the compile
+    replaying = snapshot is not None and isinstance(snapshot, piptoolscompile.snapshot.ReplaySnapshot)
+    if options.prefetch_threads and not replaying:
+        import piptoolscompile.graph
+        import piptoolscompile.index
+        index_state = piptoolscompile.index.SharedIndexState.current
+    if index_state is not None:
+        index_state.prefetch(
+            piptoolscompile.index.get_project_names(piptoolscompile.graph.get_inputs(source, options) + [dest]),
+            options.prefetch_threads
+        )
+
+    incremental = None
+    annotate_args = [arg for arg in call_args if arg in ('--annotate', '--no-annotate')]
+    if options.incremental and annotate_args and annotate_args[-1] == '--no-annotate':
+        # The "# via" annotations are the dependency graph incremental resolution builds upon
+        print('  Incremental: not available along with --no-annotate, resolving from scratch')
+    elif options.incremental:
+        import piptoolscompile.incremental
+        incremental = piptoolscompile.incremental.IncrementalResolution(dest)
+
+    success = False
     original_sys_arg = sys.argv[:]
-    with mock.patch('pip._internal.utils.misc.sys.version_info',
-                    new_callable=mock.PropertyMock(return_value=real_version_info)):
+    with compile_environment(), incremental or contextlib.ExitStack():
         try:
-            print('Running: {}'.format(' '.join(call_args)))
+            print('Running: {}'.format(' '.join(['pip-compile', '-o', dest] + call_args[3:])))
             print('  Impersonating: {}'.format(options.platform))
             print('  Mocked Python Version: {}'.format(options.py_version))
             sys.argv = call_args[:]
             log.debug('Switching sys.argv to: %s', sys.argv)
             try:
                 import piptools.scripts.compile
-                piptools.scripts.compile.cli()
+                with piptoolscompile.timings.phase('pip_compile'):
+                    piptools.scripts.compile.cli()
+                success = True
             except SystemExit as exc:
                 if exc.code == 0:
-                    return True
-                print('Failed to compile requirements. Exit code: {}'.format(exc.code))
-                return False
+                    success = True
+                else:
+                    print('Failed to compile requirements. Exit code: {}'.format(exc.code))
             except Exception:
                 print('Exception raised when processing {}'.format(source))
                 print(traceback.format_exc())
-                return False
         finally:
             log.info('Finished compiling %s', dest)
+            sys.argv = original_sys_arg
+            if index_state is not None:
+                # Nothing left to prefetch if pip-compile never looked for candidates
+                index_state.prefetch(())
 
-            if input_rewrites:
-                with open(dest) as rfh:
-                    dest_contents = rfh.read()
-
-                for input_file, rewriten_file in input_rewrites.items():
-                    if rewriten_file in dest_contents:
-                        dest_contents = dest_contents.replace(rewriten_file, input_file)
-
-                    try:
-                        os.unlink(rewriten_file)
-                    except OSError:
-                        pass
-
-                with open(dest, 'w') as wfh:
-                    wfh.write(dest_contents)
-                    for input_file, lines in passthrough_lines.items():
-                        wfh.write('# Passthrough dependencies from {}\n'.format(input_file))
-                        for line in lines:
-                            wfh.write('{}\n'.format(line))
+    if snapshot is not None and len(getattr(snapshot, 'missing', ())) > missing:
+        print('The snapshot {} is missing {} of the lookups needed to compile {}'.format(
+            snapshot.path, len(snapshot.missing) - missing, dest
+        ))
+        success = False
 
-            sys.argv = original_sys_arg
+    if not success:
+        return False
 
-    # Flag success
+    # pip-compile's header tells about the file it wrote to
+    pipeline = [piptoolscompile.postprocess.ReplaceText({
+        '--output-file={}'.format(shlex.quote(compile_dest)): '--output-file={}'.format(shlex.quote(dest))
+    })]
+    if input_rewrites:
+        pipeline.append(piptoolscompile.postprocess.ReplaceText(
+            {rewriten_file: input_file for input_file, rewriten_file in input_rewrites.items()}
+        ))
+    if passthrough_lines:
+        pipeline.append(piptoolscompile.postprocess.AppendPassthroughLines(passthrough_lines))
+    pipeline.extend(transforms)
+    with piptoolscompile.timings.phase('postprocess'):
+        changed = piptoolscompile.postprocess.postprocess(compile_dest, pipeline, dest=dest)
+    if not changed:
+        print('{} is unchanged'.format(dest))
+        piptoolscompile.timings.count('outputs_unchanged')
     return True
 
 
@@ -225,6 +305,493 @@ def show_info_to_patch():
     pprint.pprint(real_data)
 
 
+def get_targets(parser, options):
+    platforms = []
+    for value in options.platform or [platform.system().lower()]:
+        for name in value.split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in PLATFORMS:
+                parser.error(
+                    'argument --platform: invalid choice: {!r} (choose from {})'.format(
+                        name, ', '.join(repr(choice) for choice in PLATFORMS)
+                    )
+                )
+            if name not in platforms:
+                platforms.append(name)
+    py_versions = []
+    for value in options.py_version or ['{}.{}'.format(*sys.version_info)]:
+        for version in value.split(','):
+            version = version.strip()
+            if version and version not in py_versions:
+                py_versions.append(version)
+    targets = []
+    for platform_name in platforms:
+        for py_version in py_versions:
+            target_options = argparse.Namespace(**vars(options))
+            target_options.platform = platform_name
+            target_options.py_version = py_version
+            targets.append(target_options)
+    return targets
+
+
+def get_outfile_path(fpath, options):
+    source_dir = os.path.dirname(fpath)
+    if options.output_dir:
+        dest_dir = options.output_dir.format(platform=options.platform, py_version=options.py_version)
+    else:
+        dest_dir = os.path.join(source_dir, 'py{}'.format(options.py_version))
+    outfile = os.path.basename(fpath).replace('.in', '.txt')
+    if options.out_prefix:
+        outfile = '{}-{}'.format(
+            options.out_prefix.format(platform=options.platform, py_version=options.py_version),
+            outfile
+        )
+    return os.path.join(dest_dir, outfile)
+
+
+def get_fingerprint(source, options, unknown_args):
+    '''
+    Return a fingerprint of everything which goes into compiling ``source`` for the target described
+    by ``options``, or ``None`` if one of the input files cannot be read.
+
+    The requirement files referenced from within the input files are taken into account.
+    '''
+    import piptoolscompile.graph
+
+    contents = []
+    try:
+        for fpath in piptoolscompile.graph.get_inputs(source, options):
+            with open(fpath, 'rb') as rfh:
+                contents.append([fpath, hashlib.sha256(rfh.read()).hexdigest()])
+    except (IOError, OSError):
+        return None
+    data = {
+        'version': FINGERPRINT_VERSION,
+        'inputs': contents,
+        'platform': options.platform,
+        'python_version_info': list(piptoolscompile.get_python_version_info(options.py_version)),
+        'remove_line': options.remove_line,
+        'passthrough_line_from_input': options.passthrough_line_from_input,
+        'pip_compile_args': unknown_args,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_fingerprint(outfile_path):
+    try:
+        with open(outfile_path) as rfh:
+            for line in rfh:
+                if not line.startswith('#'):
+                    break
+                if line.startswith(FINGERPRINT_PREFIX):
+                    return line[len(FINGERPRINT_PREFIX):].strip()
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def forces_compile(unknown_args):
+    for arg in unknown_args:
+        if arg.split('=', 1)[0] in FORCE_COMPILE_ARGS:
+            return True
+        if arg.startswith('-P'):
+            return True
+    return False
+
+
+def get_cache_dir(unknown_args):
+    '''
+    The pip-tools cache directory pip-compile uses when passed ``unknown_args``
+    '''
+    for idx, arg in enumerate(unknown_args):
+        if arg == '--cache-dir' and idx + 1 < len(unknown_args):
+            return unknown_args[idx + 1]
+        if arg.startswith('--cache-dir='):
+            return arg.split('=', 1)[1]
+    from piptools.locations import CACHE_DIR
+    return CACHE_DIR
+
+
+def parse_size(value):
+    '''
+    Parse a size in bytes, optionally suffixed with K, M or G
+    '''
+    match = SIZE_RE.match(value.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid size: {!r}'.format(value))
+    return int(float(match.group('size')) * SIZE_UNITS[match.group('unit').upper()])
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit]:
+            return '{:.1f}{}'.format(size / SIZE_UNITS[unit], unit)
+    return '{}B'.format(int(size))
+
+
+def show_depcache_stats(cache_dir):
+    import time
+    import piptoolscompile.depcache
+
+    stats = piptoolscompile.depcache.get_stats(cache_dir)
+    cache_file = os.path.join(cache_dir, piptoolscompile.depcache.DEPCACHE_DATABASE)
+    if not stats:
+        print('No dependency cache entries in {}'.format(cache_file))
+        return
+    disk_size = sum(
+        os.path.getsize(path) for path in (cache_file, cache_file + '-wal') if os.path.exists(path)
+    )
+    print('Dependency cache {}, {} on disk'.format(cache_file, format_size(disk_size)))
+    for namespace, namespace_stats in stats.items():
+        print('  {}: {} entries, {}, last used between {} and {}'.format(
+            namespace,
+            namespace_stats['entries'],
+            format_size(namespace_stats['size']),
+            time.strftime('%Y-%m-%d', time.localtime(namespace_stats['oldest'])),
+            time.strftime('%Y-%m-%d', time.localtime(namespace_stats['latest'])),
+        ))
+    print('  Total: {} entries, {}'.format(
+        sum(namespace_stats['entries'] for namespace_stats in stats.values()),
+        format_size(sum(namespace_stats['size'] for namespace_stats in stats.values()))
+    ))
+
+
+def prune_depcache(cache_dir, options, force=True):
+    import piptoolscompile.depcache
+
+    max_age = options.depcache_max_age * 24 * 60 * 60 if options.depcache_max_age else None
+    pruned = piptoolscompile.depcache.prune(cache_dir, options.depcache_max_size, max_age, force=force)
+    if pruned is not None and (force or pruned[0]):
+        print('Evicted {} dependency cache entries, {}'.format(pruned[0], format_size(pruned[1])))
+
+
+def is_up_to_date(fpath, outfile_path, fingerprint, options, unknown_args, quiet=False):
+    if options.force or fingerprint is None or forces_compile(unknown_args):
+        return False
+    if read_fingerprint(outfile_path) != fingerprint:
+        return False
+    if not quiet:
+        print('Skipping {}, the inputs did not change since {} was compiled'.format(fpath, outfile_path))
+    return True
+
+
+def needs_compiling(targets, files, unknown_args, quiet=True):
+    '''
+    Whether any of ``files`` needs compiling for any of the ``targets``. Does not import pip.
+    '''
+    for target_options in targets:
+        for fpath in files:
+            fingerprint = get_fingerprint(fpath, target_options, unknown_args)
+            outfile_path = get_outfile_path(fpath, target_options)
+            if not is_up_to_date(fpath, outfile_path, fingerprint, target_options, unknown_args, quiet=quiet):
+                return True
+    return False
+
+
+def process_requirement_file(fpath, options, unknown_args, regexes):
+    '''
+    Compile ``fpath`` for the target described by ``options``.
+
+    Must be called with the matching impersonation in place.
+    '''
+    # Only keep the log of this fpath, to write a log file in case of an error
+    LOG_STREAM.reset()
+
+    outfile_path = get_outfile_path(fpath, options)
+    fingerprint = get_fingerprint(fpath, options, unknown_args)
+    if is_up_to_date(fpath, outfile_path, fingerprint, options, unknown_args):
+        return True
+
+    import piptoolscompile.timings
+
+    dest_dir = os.path.dirname(outfile_path)
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    with piptoolscompile.timings.record(fpath, options):
+        compiled = compile_requirement_file(fpath, outfile_path, options, unknown_args,
+                                            get_line_transforms(fpath, options, regexes, fingerprint))
+    if not compiled:
+        error_logfile = outfile_path.replace('.txt', '.log')
+        with open(error_logfile, 'w') as wfh:
+            LOG_STREAM.copy_to(wfh)
+        LOG_STREAM.reset()
+        print('Error log file at {}'.format(error_logfile))
+        return False
+
+    return True
+
+
+def get_line_transforms(fpath, options, regexes, fingerprint):
+    '''
+    The post-processing line transforms for ``fpath`` compiled for the target described by ``options``
+    '''
+    import piptoolscompile.postprocess
+
+    transforms = []
+    if regexes:
+        transforms.append(piptoolscompile.postprocess.RemoveLines(regexes, os.path.basename(__file__)))
+    transforms.extend(piptoolscompile.postprocess.get_registered_line_transforms(fpath, options))
+    if fingerprint is not None:
+        transforms.append(piptoolscompile.postprocess.SetFingerprint(FINGERPRINT_PREFIX, fingerprint))
+    return transforms
+
+
+@contextlib.contextmanager
+def shared_state():
+    '''
+    The state shared between all the compiles of a ``pip-tools-compile`` run, or, in long lived
+    processes, between all of the runs.
+    '''
+    import piptoolscompile.index
+    import piptoolscompile.hashes
+    import piptoolscompile.metadata
+
+    if _WORKER_SHARED_STATE is not None:
+        _, shared_metadata, _ = _WORKER_SHARED_STATE
+        yield shared_metadata
+        return
+    with piptoolscompile.index.SharedIndexState(), \
+            piptoolscompile.metadata.SharedMetadata() as shared_metadata, \
+            piptoolscompile.hashes.SharedHashes():
+        yield shared_metadata
+
+
+def compile_targets(targets, files, unknown_args):
+    import piptoolscompile.hacks
+    impersonations = piptoolscompile.hacks.IMPERSONATIONS
+
+    success = True
+    with shared_state() as shared_metadata:
+        if targets[0].universal:
+            for fpath in files:
+                if not fpath.endswith('.in'):
+                    continue
+                if not compile_file_universally(fpath, targets, unknown_args, shared_metadata):
+                    success = False
+            return success
+
+        for target_options in targets:
+            regexes = [re.compile(regex) for regex in target_options.remove_line]
+            with impersonations[target_options.platform](target_options.py_version, target_options.platform):
+                for fpath in files:
+                    if not fpath.endswith('.in'):
+                        continue
+                    if not process_requirement_file(fpath, target_options, unknown_args, regexes):
+                        success = False
+    return success
+
+
+def compile_file_universally(fpath, targets, unknown_args, shared_metadata):
+    '''
+    Compile ``fpath`` once per class of equivalent targets.
+
+    The first target gets compiled, and becomes the representative of its class. Each of the
+    remaining targets is projected from the first representative whose projection signature it
+    shares, or, when there's none, compiled on its own and becomes the representative of a new class.
+    '''
+    import piptoolscompile.hacks
+    import piptoolscompile.timings
+    import piptoolscompile.universal
+    impersonations = piptoolscompile.hacks.IMPERSONATIONS
+
+    def get_includes(options):
+        return [include.format(py_version=options.py_version) for include in options.include]
+
+    # (options, outfile path, pins before compiling, recorded resolution, signature)
+    representatives = []
+
+    def compile_representative(target_options, regexes):
+        '''
+        Compile ``fpath`` for ``target_options``, whose impersonation must be in place, recording
+        the resolution so that the following targets can be projected from it
+        '''
+        outfile_path = get_outfile_path(fpath, target_options)
+        existing_pins = piptoolscompile.universal.read_pins(outfile_path)
+        universal = piptoolscompile.universal.UniversalResolution(
+            [fpath] + get_includes(target_options),
+            shared_metadata
+        )
+        with universal:
+            if not process_requirement_file(fpath, target_options, unknown_args, regexes):
+                return False
+        if universal.repository is not None:
+            try:
+                with compile_environment():
+                    signature = universal.signature()
+            except piptoolscompile.universal.ProjectionConflict as exc:
+                print('Not projecting {} onto the remaining targets: {}'.format(outfile_path, exc))
+            else:
+                representatives.append((target_options, outfile_path, existing_pins, universal, signature))
+        return True
+
+    def get_representative(target_options, outfile_path):
+        '''
+        The representative ``target_options``, whose impersonation must be in place, can be projected from
+        '''
+        pins = piptoolscompile.universal.read_pins(outfile_path)
+        for representative in representatives:
+            options, _, existing_pins, universal, signature = representative
+            if get_includes(target_options) != get_includes(options) or pins != existing_pins:
+                continue
+            try:
+                with compile_environment():
+                    if universal.signature() == signature:
+                        return representative
+            except piptoolscompile.universal.ProjectionConflict as exc:
+                log.debug('Cannot project onto %s: %s', outfile_path, exc)
+        return None
+
+    success = True
+    first = targets[0]
+    with impersonations[first.platform](first.py_version, first.platform):
+        if not compile_representative(first, [re.compile(regex) for regex in first.remove_line]):
+            success = False
+
+    for target_options in targets[1:]:
+        regexes = [re.compile(regex) for regex in target_options.remove_line]
+        outfile_path = get_outfile_path(fpath, target_options)
+        with impersonations[target_options.platform](target_options.py_version, target_options.platform):
+            LOG_STREAM.reset()
+            fingerprint = get_fingerprint(fpath, target_options, unknown_args)
+            if is_up_to_date(fpath, outfile_path, fingerprint, target_options, unknown_args):
+                continue
+            representative = get_representative(target_options, outfile_path)
+            if representative is None:
+                if not compile_representative(target_options, regexes):
+                    success = False
+                continue
+            representative_outfile = representative[1]
+            print('Projecting {} onto {}'.format(representative_outfile, outfile_path))
+            transforms = []
+            if fingerprint is not None:
+                import piptoolscompile.postprocess
+                transforms.append(piptoolscompile.postprocess.SetFingerprint(FINGERPRINT_PREFIX, fingerprint))
+            with piptoolscompile.timings.record(fpath, target_options):
+                with piptoolscompile.timings.phase('projection'):
+                    changed = piptoolscompile.universal.project_output(
+                        representative_outfile, representative_outfile, outfile_path, transforms
+                    )
+                if not changed:
+                    print('{} is unchanged'.format(outfile_path))
+                    piptoolscompile.timings.count('outputs_unchanged')
+    return success
+
+
+def _get_worker_shared_state():
+    global _WORKER_SHARED_STATE
+    import piptoolscompile.index
+    import piptoolscompile.hashes
+    import piptoolscompile.metadata
+
+    if _WORKER_SHARED_STATE is None:
+        _WORKER_SHARED_STATE = (
+            piptoolscompile.index.SharedIndexState(),
+            piptoolscompile.metadata.SharedMetadata(),
+            piptoolscompile.hashes.SharedHashes(),
+        )
+        for state in _WORKER_SHARED_STATE:
+            state.__enter__()
+    return _WORKER_SHARED_STATE
+
+
+def _compile_in_worker(fpath, targets, unknown_args):
+    import piptoolscompile.hacks
+    import piptoolscompile.timings
+    impersonations = piptoolscompile.hacks.IMPERSONATIONS
+
+    _, shared_metadata, _ = _get_worker_shared_state()
+    success = False
+    timings = None
+    if targets[0].timings_json:
+        # Collected for this task only, merged by the parent process
+        timings = piptoolscompile.timings.Timings(get_profile_dir(targets[0]))
+    # Output is replayed by the parent process, in the same order the serial path would produce it
+    with CatureSTDs(replay=False) as capstds, contextlib.ExitStack() as stack:
+        if timings is not None:
+            stack.enter_context(timings)
+        try:
+            if targets[0].universal:
+                success = compile_file_universally(fpath, targets, unknown_args, shared_metadata)
+            else:
+                options = targets[0]
+                regexes = [re.compile(regex) for regex in options.remove_line]
+                with impersonations[options.platform](options.py_version, options.platform):
+                    success = process_requirement_file(fpath, options, unknown_args, regexes)
+        except Exception:
+            print('Exception raised when processing {}'.format(fpath))
+            print(traceback.format_exc())
+    try:
+        return success, capstds.stdout, capstds.stderr, timings.as_dict() if timings is not None else None
+    finally:
+        capstds.close()
+
+
+def compile_targets_in_parallel(targets, files, unknown_args, jobs):
+    import concurrent.futures
+
+    if targets[0].universal:
+        # Each file is resolved once for all of the targets
+        work = [(fpath, targets) for fpath in files if fpath.endswith('.in')]
+    else:
+        work = [
+            (fpath, [target_options])
+            for target_options in targets
+            for fpath in files
+            if fpath.endswith('.in')
+        ]
+
+    success = True
+    futures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        for fpath, file_targets in work:
+            futures.append(
+                (fpath, executor.submit(_compile_in_worker, fpath, file_targets, unknown_args))
+            )
+        for fpath, future in futures:
+            try:
+                compiled, stdout, stderr, timings = future.result()
+            except Exception:
+                compiled = False
+                stdout = 'Exception raised when processing {}\n{}\n'.format(fpath, traceback.format_exc())
+                stderr = ''
+                timings = None
+            if timings is not None:
+                import piptoolscompile.timings
+                if piptoolscompile.timings.Timings.current is not None:
+                    piptoolscompile.timings.Timings.current.merge(timings)
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            if not compiled:
+                success = False
+    return success
+
+
+def get_profile_dir(options):
+    '''
+    Where ``--profile`` dumps the pstats of each compile, next to the ``--timings-json`` file
+    '''
+    if not options.profile:
+        return None
+    return '{}-profiles'.format(os.path.splitext(options.timings_json)[0])
+
+
+def finish_snapshot(snapshot):
+    '''
+    Leave the snapshot mode, packing what got recorded into the snapshot archive
+    '''
+    import piptoolscompile.snapshot
+    active = piptoolscompile.snapshot.Snapshot.current
+    if active is not None and active.spec == snapshot.spec:
+        active.__exit__(None, None, None)
+    try:
+        if isinstance(snapshot, piptoolscompile.snapshot.RecordSnapshot):
+            snapshot.pack()
+    finally:
+        snapshot.cleanup()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -234,13 +801,35 @@ def main():
     )
     parser.add_argument(
         '--platform',
-        choices=('windows', 'darwin', 'linux'),
-        default=platform.system().lower()
+        action='append',
+        default=None,
+        help=(
+            'The platform to impersonate, one of {}. Can be passed several times, or as a comma '
+            'separated list, to compile for each of them. Defaults to the current platform'.format(
+                ', '.join(PLATFORMS)
+            )
+        )
+    )
+    parser.add_argument(
+        '--py-version',
+        action='append',
+        default=None,
+        help=(
+            'The python version to impersonate. Can be passed several times, or as a comma '
+            'separated list, to compile for each of them. Defaults to the current python version'
+        )
     )
-    parser.add_argument('--py-version', default='{}.{}'.format(*sys.version_info))
     parser.add_argument('--include', action='append', default=[])
-    parser.add_argument('--output-dir', default=None)
-    parser.add_argument('--out-prefix', default=None)
+    parser.add_argument(
+        '--output-dir',
+        default=None,
+        help='Can include {platform} and {py_version} which will be formatted for each target'
+    )
+    parser.add_argument(
+        '--out-prefix',
+        default=None,
+        help='Can include {platform} and {py_version} which will be formatted for each target'
+    )
     parser.add_argument(
         '--remove-line', default=[], action='append',
         help='Python regular experession to search and remove from the compiled requirements and remove it'
@@ -249,6 +838,144 @@ def main():
         '--passthrough-line-from-input', default=[], action='append',
         help='Python regular experession to search and remove from the input requirements and append in the destination requirements file'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes to compile requirement files with. 0 means one per CPU. Defaults to 1'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Compile the requirement files even if their inputs did not change since they were last compiled'
+    )
+    parser.add_argument(
+        '--universal',
+        action='store_true',
+        help=(
+            'Resolve each requirement file once, for the first target, and reuse the result for every other '
+            'target on which it projects without differences, only resolving again for the remaining ones'
+        )
+    )
+    daemon_mode = parser.add_mutually_exclusive_group()
+    daemon_mode.add_argument(
+        '--daemon',
+        action='store_true',
+        help='Keep running, compiling the requests of pip-tools-compile --client, in the foreground'
+    )
+    daemon_mode.add_argument(
+        '--client',
+        action='store_true',
+        help='Have the running pip-tools-compile --daemon do the compiling. Compiles in process when none is running'
+    )
+    parser.add_argument(
+        '--socket',
+        default=None,
+        help=(
+            'The Unix socket the daemon listens on. Defaults to $PIP_TOOLS_COMPILE_SOCKET, or to a '
+            'socket in $XDG_RUNTIME_DIR, or in a per user directory in the temporary directory'
+        )
+    )
+    snapshot_mode = parser.add_mutually_exclusive_group()
+    snapshot_mode.add_argument(
+        '--record-snapshot',
+        default=None,
+        metavar='PATH',
+        help=(
+            'Record every index page and artifact fetched while compiling into the PATH archive. '
+            'Implies --force'
+        )
+    )
+    snapshot_mode.add_argument(
+        '--replay-snapshot',
+        default=None,
+        metavar='PATH',
+        help=(
+            'Serve every index page and artifact from the PATH archive, written by --record-snapshot, '
+            'without any network access. Lookups missing from it fail the compile'
+        )
+    )
+    parser.add_argument(
+        '--timings-json',
+        default=None,
+        metavar='PATH',
+        help=(
+            'Write the duration of each phase, per compiled file and target, along with the cache hits, '
+            'misses and HTTP requests counters, to PATH as JSON'
+        )
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Along with --timings-json, dump the cProfile stats of each compiled file and target next to it'
+    )
+    parser.add_argument(
+        '--prefetch-threads',
+        type=int,
+        default=8,
+        metavar='N',
+        help=(
+            'Number of threads fetching, ahead of time, the index pages of the projects named by the '
+            'requirement files, their inputs and their last compiled requirements. 0 disables prefetching. '
+            'Defaults to 8'
+        )
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help=(
+            'Only resolve again the pins affected by the changes to the requirement files, or by '
+            '--upgrade-package, since they were last compiled, keeping the other pins fixed. Requires '
+            'the "# via" annotations, it resolves from scratch along with --no-annotate'
+        )
+    )
+    parser.add_argument(
+        '--graph',
+        default=None,
+        metavar='PATH',
+        help=(
+            'Keep track, in the PATH JSON file, of the requirement files each compiled requirements file '
+            'depends on, through --include and -r/-c lines'
+        )
+    )
+    parser.add_argument(
+        '--changed',
+        nargs='+',
+        default=None,
+        metavar='FILE',
+        help=(
+            'Along with --graph, compile the requirement files which depend on any of the FILEs, '
+            'as of their last compile, on top of the ones passed'
+        )
+    )
+    depcache_mode = parser.add_mutually_exclusive_group()
+    depcache_mode.add_argument(
+        '--depcache-stats',
+        action='store_true',
+        help='Print the number of entries, and their size, of each target in the dependency cache, and exit'
+    )
+    depcache_mode.add_argument(
+        '--depcache-prune',
+        action='store_true',
+        help='Evict the dependency cache entries over --depcache-max-size or --depcache-max-age, and exit'
+    )
+    parser.add_argument(
+        '--depcache-max-size',
+        type=parse_size,
+        default='64M',
+        metavar='SIZE',
+        help=(
+            'Evict the least recently used dependency cache entries, once a day, when compiling, past SIZE '
+            'bytes, which can be suffixed with K, M or G. 0 disables it. Defaults to 64M'
+        )
+    )
+    parser.add_argument(
+        '--depcache-max-age',
+        type=float,
+        default=None,
+        metavar='DAYS',
+        help='Also evict the dependency cache entries not used for DAYS'
+    )
     parser.add_argument('files', nargs='*')
 
     options, unknown_args = parser.parse_known_args()
@@ -257,84 +984,132 @@ def main():
         show_info_to_patch()
         parser.exit(0)
 
-    if not options.files:
+    if options.depcache_stats or options.depcache_prune:
+        cache_dir = get_cache_dir(unknown_args)
+        if options.depcache_stats:
+            show_depcache_stats(cache_dir)
+        else:
+            prune_depcache(cache_dir, options)
+        parser.exit(0)
+
+    if options.daemon or options.client:
+        import piptoolscompile.daemon
+        if not piptoolscompile.daemon.HAS_UNIX_SOCKETS:
+            parser.error('--daemon and --client require Unix sockets, which are not available on this platform')
+        socket_path = options.socket or piptoolscompile.daemon.get_socket_path()
+        if options.daemon:
+            sys.exit(piptoolscompile.daemon.serve(socket_path))
+        exitcode = piptoolscompile.daemon.run_client(
+            [arg for arg in sys.argv if arg != '--client'],
+            socket_path
+        )
+        if exitcode is not None:
+            sys.exit(exitcode)
+
+    if not options.files and not options.changed:
         parser.exit(2, 'Please pass at least one requirement file')
 
-    import piptoolscompile.hacks
-    impersonations = piptoolscompile.hacks.IMPERSONATIONS
+    if options.jobs < 0:
+        parser.error('argument -j/--jobs: must not be negative')
 
-    regexes = []
-    for regex in options.remove_line:
-        regexes.append(re.compile(regex))
+    if options.prefetch_threads < 0:
+        parser.error('argument --prefetch-threads: must not be negative')
 
-    stdout = stderr = None
-    exitcode = 0
+    if options.profile and not options.timings_json:
+        parser.error('argument --profile: requires --timings-json')
 
-    with CatureSTDs() as capstds:
-        with impersonations[options.platform](options.py_version, options.platform):
-            import piptools.scripts.compile
-            for fpath in options.files:
-                if not fpath.endswith('.in'):
-                    continue
+    if options.changed and not options.graph:
+        parser.error('argument --changed: requires --graph')
 
-                # Return the log strem to 0, either to write a log file in case of an error,
-                # or to overwrite the contents for this next fpath
-                LOG_STREAM.seek(0)
+    graph = None
+    if options.graph:
+        import piptoolscompile.graph
+        graph = piptoolscompile.graph.IncludeGraph(options.graph).load()
+        if options.changed:
+            for fpath in options.changed + graph.get_affected_sources(options.changed):
+                if fpath.endswith('.in') and fpath not in options.files:
+                    options.files.append(fpath)
 
-                source_dir = os.path.dirname(fpath)
-                if options.output_dir:
-                    dest_dir = options.output_dir
-                else:
-                    dest_dir = os.path.join(source_dir, 'py{}'.format(options.py_version))
-                if not os.path.isdir(dest_dir):
-                    os.makedirs(dest_dir)
-                outfile = os.path.basename(fpath).replace('.in', '.txt')
-                if options.out_prefix:
-                    outfile = '{}-{}'.format(options.out_prefix, outfile)
-                outfile_path = os.path.join(dest_dir, outfile)
-                if not compile_requirement_file(fpath, outfile_path, options, unknown_args):
-                    exitcode = 1
-                    error_logfile = outfile_path.replace('.txt', '.log')
-                    with open(error_logfile, 'w') as wfh:
-                        wfh.write(LOG_STREAM.read())
-                        LOG_STREAM.seek(0)
-                        print('Error log file at {}'.format(error_logfile))
-                    continue
+    requirement_files = [fpath for fpath in options.files if fpath.endswith('.in')]
+    if not requirement_files:
+        # pre-commit passes every file matching the hook, there's nothing to compile
+        parser.exit(0)
 
-                if not regexes:
-                    continue
+    options.snapshot = None
+    targets = get_targets(parser, options)
+    outfile_paths = {}
+    for target_options in targets:
+        for fpath in options.files:
+            if not fpath.endswith('.in'):
+                continue
+            target = '{}/py{}'.format(target_options.platform, target_options.py_version)
+            outfile_path = get_outfile_path(fpath, target_options)
+            if outfile_paths.get(outfile_path, target) != target:
+                parser.error(
+                    'Both {} and {} would compile {} to {}. Please include {{platform}} and/or '
+                    '{{py_version}} in --out-prefix or --output-dir'.format(
+                        outfile_paths[outfile_path], target, fpath, outfile_path
+                    )
+                )
+            outfile_paths[outfile_path] = target
+            if graph is not None:
+                graph.update(fpath, outfile_path, target_options)
+    if graph is not None:
+        graph.write()
+
+    snapshot = None
+    if options.record_snapshot or options.replay_snapshot:
+        import piptoolscompile.snapshot
+        if options.record_snapshot:
+            snapshot = piptoolscompile.snapshot.RecordSnapshot(options.record_snapshot)
+        else:
+            snapshot = piptoolscompile.snapshot.ReplaySnapshot(options.replay_snapshot)
+            try:
+                snapshot.validate()
+            except ValueError as exc:
+                snapshot.cleanup()
+                parser.error(str(exc))
+        for target_options in targets:
+            target_options.snapshot = snapshot.spec
+            if options.record_snapshot:
+                # Up to date requirement files would not be recorded
+                target_options.force = True
+
+    exitcode = 0
+
+    import piptoolscompile.includes
+    import piptoolscompile.timings
+
+    timings = None
+    if options.timings_json:
+        timings = piptoolscompile.timings.Timings(get_profile_dir(options))
+
+    # The preprocessed includes are shared by every compile of the run, worker processes included
+    with CatureSTDs() as capstds, piptoolscompile.includes.PreprocessedIncludes():
+        try:
+            if not needs_compiling(targets, requirement_files, unknown_args):
+                # Nothing changed, skip importing pip and pip-tools altogether
+                needs_compiling(targets, requirement_files, unknown_args, quiet=False)
+            else:
+                with contextlib.ExitStack() as stack:
+                    if timings is not None:
+                        stack.enter_context(timings)
+                    if options.jobs == 1:
+                        if not compile_targets(targets, options.files, unknown_args):
+                            exitcode = 1
+                    elif not compile_targets_in_parallel(targets, options.files, unknown_args, options.jobs):
+                        exitcode = 1
+                if snapshot is None:
+                    prune_depcache(get_cache_dir(unknown_args), options, force=False)
+        finally:
+            if snapshot is not None:
+                finish_snapshot(snapshot)
+            if timings is not None:
+                timings.write(options.timings_json)
 
-                with open(outfile_path, 'r') as rfh:
-                    in_contents = rfh.read()
-
-                out_contents = []
-                for line in in_contents.splitlines():
-                    print('Processing line: {!r} // {}'.format(line, [r.pattern for r in regexes]))
-                    for regex in regexes:
-                        if regex.match(line):
-                            print("Line commented out by regex '{}': '{}'".format(regex.pattern, line))
-                            line = textwrap.dedent('''\
-                                # Next line explicitly commented out by {} because of the following regex: '{}'
-                                # {}'''.format(
-                                    os.path.basename(__file__),
-                                    regex.pattern,
-                                    line
-                                )
-                            )
-                            break
-                    out_contents.append(line)
-
-                with open(outfile_path, 'w') as wfh:
-                    wfh.write(os.linesep.join(out_contents) + os.linesep)
-
-            if exitcode:
-                stdout = capstds.stdout
-                stderr = capstds.stderr
-
-    if stdout:
-        sys.__stdout__.write(capstds.stdout)
-    if stderr:
-        sys.__stderr__.write(capstds.stderr)
+    if exitcode:
+        capstds.replay()
+    capstds.close()
     sys.exit(exitcode)
 
 
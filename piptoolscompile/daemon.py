@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.daemon
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Keep ``pip-tools-compile`` warm in a long running process.
+
+    ``pip-tools-compile --daemon`` imports pip and pip-tools once, keeps the pip HTTP sessions and the
+    shared wheel metadata around, and compiles the requests it gets over a Unix socket, one at a time.
+    ``pip-tools-compile --client`` forwards its arguments, working directory and the environment
+    variables pip reads to it, streams back the output and exits with the same exit code. When no
+    daemon is listening, the client compiles in its own process.
+
+    The socket lives in a directory only the current user can access, ``$XDG_RUNTIME_DIR`` or a per
+    user directory in the temporary directory. Before sending anything, the client makes sure the
+    socket, and the daemon listening on it, belong to the current user and nobody else can connect.
+
+    The protocol is one JSON document per line. The client sends its request, the daemon answers with
+    ``{"stream": "stdout" | "stderr", "data": "..."}`` messages, followed by ``{"exitcode": N}``.
+'''
+
+# Import Python Libs
+import io
+import os
+import sys
+import json
+import stat
+import socket
+import signal
+import struct
+import logging
+import tempfile
+import importlib
+import traceback
+
+log = logging.getLogger(__name__)
+
+HAS_UNIX_SOCKETS = hasattr(socket, 'AF_UNIX')
+SOCKET_ENV_VAR = 'PIP_TOOLS_COMPILE_SOCKET'
+SOCKET_NAME = 'pip-tools-compile.sock'
+# struct ucred, the pid, uid and gid of the process on the other end of a Unix socket
+PEERCRED = struct.Struct('3i')
+
+# The environment variables the client forwards, the ones pip and requests read, along with the
+# pip-tools-compile ones. The daemon keeps its own environment otherwise.
+FORWARDED_ENV_PREFIXES = ('PIP_',)
+FORWARDED_ENV_VARS = (
+    'CAPTURE_OUTPUT',
+    'HTTP_PROXY',
+    'HTTPS_PROXY',
+    'FTP_PROXY',
+    'ALL_PROXY',
+    'NO_PROXY',
+    'REQUESTS_CA_BUNDLE',
+    'CURL_CA_BUNDLE',
+    'SSL_CERT_FILE',
+    'SSL_CERT_DIR',
+    'VIRTUAL_ENV',
+)
+
+# The process wide state a request changes while it's handled, ``(module, attribute)``. Anything still
+# changed once the request is handled leaked from it, and gets restored.
+PROCESS_STATE = (
+    ('sys', 'argv'),
+    ('sys', 'stdout'),
+    ('sys', 'stderr'),
+    ('sys', 'version_info'),
+    ('sys', 'platform'),
+    ('os', 'name'),
+    ('platform', 'python_version'),
+    ('platform', 'machine'),
+    ('platform', 'release'),
+    ('platform', 'system'),
+    ('platform', 'version'),
+    ('pip._internal.pep425tags', 'get_impl_version_info'),
+    ('pip._internal.pep425tags', 'get_config_var'),
+    ('pip._internal.pep425tags', 'get_platform'),
+    ('pip._internal.pep425tags', 'get_supported'),
+    ('pip._internal.index', 'get_supported'),
+    ('pip._internal.wheel', 'Wheel.supported'),
+    ('pip._internal.download', '_copy_file'),
+    ('pip._internal.download', 'PipSession.get_adapter'),
+    ('pip._internal.download', 'PipSession.send'),
+    ('piptools.resolver', 'Resolver._resolve_one_round'),
+    ('piptools.scripts.compile', 'DependencyCache'),
+    ('piptoolscompile.cli', 'CAPTURE_OUTPUT'),
+)
+
+
+def get_socket_dir():
+    '''
+    The directory, private to the current user, holding the daemon's socket by default
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+    return os.path.join(tempfile.gettempdir(), 'pip-tools-compile-{}'.format(os.getuid()))
+
+
+def get_socket_path():
+    if os.environ.get(SOCKET_ENV_VAR):
+        return os.environ[SOCKET_ENV_VAR]
+    return os.path.join(get_socket_dir(), SOCKET_NAME)
+
+
+def get_private_path_error(path, is_dir=False):
+    '''
+    Return why ``path``, a directory when ``is_dir`` is set, a socket otherwise, is not private to
+    the current user, or ``None`` when it is
+    '''
+    path_stat = os.lstat(path)
+    if is_dir and not stat.S_ISDIR(path_stat.st_mode):
+        return '{} is not a directory'.format(path)
+    if not is_dir and not stat.S_ISSOCK(path_stat.st_mode):
+        return '{} is not a socket'.format(path)
+    if path_stat.st_uid != os.getuid():
+        return '{} belongs to another user'.format(path)
+    if path_stat.st_mode & 0o077:
+        return '{} is accessible by other users, its mode is {:o}'.format(path, stat.S_IMODE(path_stat.st_mode))
+    return None
+
+
+def is_forwarded(name):
+    name = name.upper()
+    return name.startswith(FORWARDED_ENV_PREFIXES) or name in FORWARDED_ENV_VARS
+
+
+def get_forwarded_environ(environ):
+    '''
+    Return the variables of ``environ`` the client forwards to the daemon
+    '''
+    return {name: value for name, value in environ.items() if is_forwarded(name)}
+
+
+def send_message(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class ProcessState(object):
+    '''
+    Snapshot of the process wide state a request could leak into the next ones
+    '''
+
+    def __init__(self):
+        self._attributes = {}
+        for module_name, attribute in PROCESS_STATE:
+            owner, name = self._resolve(module_name, attribute)
+            self._attributes[(module_name, attribute)] = (owner, name, getattr(owner, name))
+        self._environ = dict(os.environ)
+        self._cwd = os.getcwd()
+
+    @staticmethod
+    def _resolve(module_name, attribute):
+        owner = importlib.import_module(module_name)
+        parts = attribute.split('.')
+        for part in parts[:-1]:
+            owner = getattr(owner, part)
+        return owner, parts[-1]
+
+    def restore(self):
+        for (module_name, attribute), (owner, name, value) in self._attributes.items():
+            if getattr(owner, name) is not value:
+                if attribute not in ('argv', 'stdout', 'stderr', 'CAPTURE_OUTPUT'):
+                    # Those are expected to change, anything else is a leak
+                    log.error('Restoring %s.%s, which was left patched', module_name, attribute)
+                setattr(owner, name, value)
+        if dict(os.environ) != self._environ:
+            os.environ.clear()
+            os.environ.update(self._environ)
+        os.chdir(self._cwd)
+
+
+class MessageStream(io.TextIOBase):
+    '''
+    Text stream sending whatever gets written to it to the client
+    '''
+
+    def __init__(self, connection, name):
+        super(MessageStream, self).__init__()
+        self._connection = connection
+        self._name = name
+        self._connected = True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not isinstance(data, str):
+            # Like any text stream, which is how click tells it apart from a binary one
+            raise TypeError('write() argument must be str, not {}'.format(type(data).__name__))
+        if data and self._connected:
+            try:
+                send_message(self._connection, {'stream': self._name, 'data': data})
+            except OSError:
+                # The client went away, finish the request anyway
+                self._connected = False
+        return len(data)
+
+
+def get_exitcode(exc):
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    sys.stderr.write('{}\n'.format(exc.code))
+    return 1
+
+
+def handle_request(connection, request, index_state):
+    import piptoolscompile.cli
+
+    exitcode = 1
+    state = ProcessState()
+    try:
+        environ = {name: value for name, value in os.environ.items() if not is_forwarded(name)}
+        environ.update(get_forwarded_environ(request['environ']))
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(request['cwd'])
+        sys.argv = list(request['argv'])
+        sys.stdout = MessageStream(connection, 'stdout')
+        sys.stderr = MessageStream(connection, 'stderr')
+        piptoolscompile.cli.CAPTURE_OUTPUT = os.environ.get('CAPTURE_OUTPUT', '1') == '1'
+        piptoolscompile.cli.LOG_STREAM.reset()
+        index_state.clear_pages()
+        if '--daemon' in sys.argv[1:]:
+            sys.stderr.write('The pip-tools-compile daemon cannot start another daemon\n')
+            exitcode = 2
+        else:
+            try:
+                piptoolscompile.cli.main()
+                exitcode = 0
+            except SystemExit as exc:
+                exitcode = get_exitcode(exc)
+    except Exception:  # pylint: disable=broad-except
+        sys.stderr.write('Exception raised when handling the request\n{}'.format(traceback.format_exc()))
+    finally:
+        state.restore()
+    try:
+        send_message(connection, {'exitcode': exitcode})
+    except OSError:
+        log.debug('The client went away before getting the exit code')
+
+
+def serve(socket_path):
+    '''
+    Compile the requests sent to ``socket_path`` until terminated. Returns the exit code.
+    '''
+    import piptoolscompile.cli
+    # Import, and warm up, everything a request needs
+    import piptools.scripts.compile  # pylint: disable=unused-import
+    index_state, _, _ = piptoolscompile.cli._get_worker_shared_state()
+
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, mode=0o700)
+    if socket_dir == os.path.abspath(get_socket_dir()):
+        error = get_private_path_error(socket_dir, is_dir=True)
+        if error is not None:
+            sys.stderr.write('Not listening on {}: {}\n'.format(socket_path, error))
+            return 1
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Left behind by a daemon which did not shut down cleanly
+            os.unlink(socket_path)
+        else:
+            sys.stderr.write('A pip-tools-compile daemon is already listening on {}\n'.format(socket_path))
+            return 1
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user gets to send requests
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+
+    def terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    print('Listening on {}'.format(socket_path))
+    sys.stdout.flush()
+    try:
+        while True:
+            connection, _ = server.accept()
+            try:
+                with connection.makefile('rb') as rfh:
+                    line = rfh.readline()
+                if not line:
+                    continue
+                handle_request(connection, json.loads(line.decode('utf-8')), index_state)
+            finally:
+                connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        for shared_state in piptoolscompile.cli._WORKER_SHARED_STATE:
+            shared_state.__exit__(None, None, None)
+    return 0
+
+
+def run_client(argv, socket_path):
+    '''
+    Have the daemon listening on ``socket_path`` run ``argv``. Returns the exit code, or ``None``
+    when no daemon is listening.
+    '''
+    try:
+        error = get_private_path_error(socket_path)
+    except OSError:
+        # No daemon ever listened there
+        return None
+    if error is None and os.path.dirname(os.path.abspath(socket_path)) == os.path.abspath(get_socket_dir()):
+        error = get_private_path_error(get_socket_dir(), is_dir=True)
+    if error is not None:
+        sys.stderr.write('Not using the pip-tools-compile daemon: {}\n'.format(error))
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    with client:
+        if hasattr(socket, 'SO_PEERCRED'):
+            # The socket could have been replaced since it was checked, the process listening on it cannot
+            credentials = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+            _, peer_uid, _ = PEERCRED.unpack(credentials)
+            if peer_uid != os.getuid():
+                sys.stderr.write(
+                    'Not using the pip-tools-compile daemon: {} is served by another user\n'.format(socket_path)
+                )
+                return None
+        send_message(client, {'argv': argv, 'cwd': os.getcwd(), 'environ': get_forwarded_environ(os.environ)})
+        with client.makefile('rb') as rfh:
+            for line in rfh:
+                message = json.loads(line.decode('utf-8'))
+                if 'exitcode' in message:
+                    return message['exitcode']
+                stream = sys.stdout if message['stream'] == 'stdout' else sys.stderr
+                stream.write(message['data'])
+                stream.flush()
+    sys.stderr.write('The pip-tools-compile daemon closed the connection before finishing\n')
+    return 1
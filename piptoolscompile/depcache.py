@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.depcache
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    pip-tools dependency cache which several ``pip-tools-compile`` processes can share.
+
+    pip-tools' ``DependencyCache`` rewrites a whole JSON file every time an entry is added, so two
+    processes writing to the same file either lose each other's entries or, worse, leave a
+    truncated file behind. Here every entry is a row of a SQLite database in WAL mode, where
+    readers never block and writers only wait for one another while inserting a single row.
+
+    Nothing gets loaded up front, each entry is looked up, through the primary key index, the first
+    time the resolver asks for it. Every entry remembers when it was last used, at an hour's
+    granularity, so that ``prune`` can evict the least recently used entries once the database
+    grows over a given size, and the entries not used for a given time. ``--depcache-stats`` and
+    ``--depcache-prune`` report and prune the database of the pip-tools cache directory.
+
+    The shared wheel metadata and built sdist metadata, see ``piptoolscompile.metadata``, are stored
+    in the same table, under namespaces of their own, and get evicted the same way.
+'''
+
+# Import Python Libs
+import os
+import json
+import time
+import logging
+try:
+    import sqlite3
+except ImportError:
+    # Python built without the sqlite3 module
+    sqlite3 = None
+
+# Import pip-tools Libs
+# Keep a reference to the original DependencyCache class
+from piptools.cache import DependencyCache
+
+# Import pip-tools-compile Libs
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+DEPCACHE_DATABASE = 'depcache.sqlite'
+# How long, in seconds, to wait for other processes to finish writing
+DEPCACHE_TIMEOUT = 60
+# How often, in seconds, the last use of an entry gets updated
+DEPCACHE_TOUCH_INTERVAL = 60 * 60
+# How often, in seconds, compiling prunes the database
+DEPCACHE_PRUNE_INTERVAL = 24 * 60 * 60
+# The size, in bytes, the database gets pruned down to by default
+DEPCACHE_MAX_SIZE = 64 * 1024 * 1024
+# The size an entry accounts for
+ENTRY_SIZE = 'length(namespace) + length(name) + length(version) + length(dependencies)'
+
+
+def connect(cache_file):
+    '''
+    Connect to the SQLite database at ``cache_file``, creating, or upgrading, its tables
+    '''
+    connection = sqlite3.connect(cache_file, timeout=DEPCACHE_TIMEOUT, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS dependencies ('
+        '  namespace TEXT NOT NULL,'
+        '  name TEXT NOT NULL,'
+        '  version TEXT NOT NULL,'
+        '  dependencies TEXT NOT NULL,'
+        '  last_used INTEGER NOT NULL DEFAULT 0,'
+        '  PRIMARY KEY (namespace, name, version)'
+        ')'
+    )
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(dependencies)')]
+    if 'last_used' not in columns:
+        # Written before entries were evicted, count them as used now
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(dependencies)')]
+            if 'last_used' not in columns:
+                connection.execute('ALTER TABLE dependencies ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0')
+                connection.execute('UPDATE dependencies SET last_used = ?', (int(time.time()),))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    connection.execute('CREATE INDEX IF NOT EXISTS dependencies_last_used ON dependencies (last_used)')
+    connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    return connection
+
+
+def read_entry(connection, namespace, name, version):
+    '''
+    Return the JSON document stored as the ``(namespace, name, version)`` entry, or ``None``, and
+    record it was used
+    '''
+    row = connection.execute(
+        'SELECT dependencies, last_used FROM dependencies WHERE namespace = ? AND name = ? AND version = ?',
+        (namespace, name, version)
+    ).fetchone()
+    if row is None:
+        return None
+    now = int(time.time())
+    if row[1] < now - DEPCACHE_TOUCH_INTERVAL:
+        connection.execute(
+            'UPDATE dependencies SET last_used = ? WHERE namespace = ? AND name = ? AND version = ?',
+            (now, namespace, name, version)
+        )
+    return json.loads(row[0])
+
+
+def write_entry(connection, namespace, name, version, value):
+    '''
+    Store the JSON serializable ``value`` as the ``(namespace, name, version)`` entry
+    '''
+    connection.execute(
+        'INSERT OR REPLACE INTO dependencies (namespace, name, version, dependencies, last_used) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (namespace, name, version, json.dumps(value), int(time.time()))
+    )
+
+
+class SQLiteDependencyCache(DependencyCache):
+    '''
+    ``DependencyCache`` storing its entries under ``namespace`` in a shared SQLite database
+    '''
+
+    def __init__(self, cache_dir, namespace):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self._cache_file = os.path.join(cache_dir, DEPCACHE_DATABASE)
+        self._namespace = namespace
+        self._cache = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = connect(self._cache_file)
+        return self._connection
+
+    def read_cache(self):
+        '''
+        Entries are only read into memory as they get looked up
+        '''
+        self._cache = {}
+
+    def write_cache(self):
+        # Entries are written to the database as they get set
+        pass
+
+    def lookup(self, pkgname, pkgversion_and_extras):
+        '''
+        Look up an entry which is not in memory yet
+        '''
+        dependencies = read_entry(self.connection, self._namespace, pkgname, pkgversion_and_extras)
+        if dependencies is None:
+            return None
+        self.cache.setdefault(pkgname, {})[pkgversion_and_extras] = dependencies
+        return dependencies
+
+    def clear(self):
+        self._cache = {}
+        self.connection.execute('DELETE FROM dependencies WHERE namespace = ?', (self._namespace,))
+
+    def __contains__(self, ireq):
+        pkgname, pkgversion_and_extras = self.as_cache_key(ireq)
+        if pkgversion_and_extras in self.cache.get(pkgname, {}):
+            piptoolscompile.timings.count('depcache_hits')
+            return True
+        if self.lookup(pkgname, pkgversion_and_extras) is not None:
+            piptoolscompile.timings.count('depcache_hits')
+            return True
+        piptoolscompile.timings.count('depcache_misses')
+        return False
+
+    def __getitem__(self, ireq):
+        pkgname, pkgversion_and_extras = self.as_cache_key(ireq)
+        try:
+            return self.cache[pkgname][pkgversion_and_extras]
+        except KeyError:
+            dependencies = self.lookup(pkgname, pkgversion_and_extras)
+            if dependencies is None:
+                raise
+            return dependencies
+
+    def __setitem__(self, ireq, values):
+        pkgname, pkgversion_and_extras = self.as_cache_key(ireq)
+        self.cache.setdefault(pkgname, {})[pkgversion_and_extras] = values
+        write_entry(self.connection, self._namespace, pkgname, pkgversion_and_extras, values)
+
+
+def get_dependency_cache(version_info, platform, cache_dir):
+    '''
+    Return the dependency cache for the impersonated ``platform`` and ``version_info``
+    '''
+    namespace = 'depcache-{}-py{}.{}'.format(platform, *version_info)
+    if sqlite3 is None:
+        depcache = DependencyCache(cache_dir)
+        depcache._cache_file = os.path.join(cache_dir, '{}.json'.format(namespace))
+        log.warning(
+            'The sqlite3 module is not available, falling back to %s, which is not safe to share '
+            'between concurrent processes', depcache._cache_file
+        )
+        return depcache
+    depcache = SQLiteDependencyCache(cache_dir, namespace)
+    log.info('Storing the pip-tools depcache entries under %s in %s', namespace, depcache._cache_file)
+    return depcache
+
+
+def get_stats(cache_dir):
+    '''
+    Return the number of entries, their size, and the oldest and latest last use, per namespace, of
+    the database in ``cache_dir``
+    '''
+    cache_file = os.path.join(cache_dir, DEPCACHE_DATABASE)
+    if sqlite3 is None or not os.path.exists(cache_file):
+        return {}
+    connection = connect(cache_file)
+    try:
+        rows = connection.execute(
+            'SELECT namespace, COUNT(*), SUM({}), MIN(last_used), MAX(last_used) '
+            'FROM dependencies GROUP BY namespace ORDER BY namespace'.format(ENTRY_SIZE)
+        ).fetchall()
+    finally:
+        connection.close()
+    return {
+        namespace: {'entries': entries, 'size': size, 'oldest': oldest, 'latest': latest}
+        for namespace, entries, size, oldest, latest in rows
+    }
+
+
+def prune(cache_dir, max_size=DEPCACHE_MAX_SIZE, max_age=None, force=True):
+    '''
+    Evict the entries of the database in ``cache_dir`` not used for ``max_age`` seconds, then the
+    least recently used ones until the remaining ones fit in ``max_size`` bytes. Unless ``force``
+    is set, only prune if it was not pruned for ``DEPCACHE_PRUNE_INTERVAL``.
+
+    Returns the number of evicted entries and their size, or ``None`` when it was not pruned.
+    '''
+    cache_file = os.path.join(cache_dir, DEPCACHE_DATABASE)
+    if sqlite3 is None or not os.path.exists(cache_file):
+        return None
+    now = int(time.time())
+    connection = connect(cache_file)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute("SELECT value FROM metadata WHERE key = 'last_pruned'").fetchone()
+            if not force and row is not None and int(row[0]) > now - DEPCACHE_PRUNE_INTERVAL:
+                connection.execute('ROLLBACK')
+                return None
+            evicted = []
+            if max_age:
+                evicted.extend(connection.execute(
+                    'SELECT rowid, {} FROM dependencies WHERE last_used < ?'.format(ENTRY_SIZE),
+                    (now - max_age,)
+                ))
+            if max_size:
+                size = connection.execute('SELECT TOTAL({}) FROM dependencies'.format(ENTRY_SIZE)).fetchone()[0]
+                size -= sum(entry_size for _, entry_size in evicted)
+                evicted_rowids = {rowid for rowid, _ in evicted}
+                rows = connection.execute(
+                    'SELECT rowid, {} FROM dependencies ORDER BY last_used, rowid'.format(ENTRY_SIZE)
+                )
+                try:
+                    for rowid, entry_size in rows:
+                        if size <= max_size:
+                            break
+                        if rowid in evicted_rowids:
+                            continue
+                        evicted.append((rowid, entry_size))
+                        size -= entry_size
+                finally:
+                    rows.close()
+            connection.executemany('DELETE FROM dependencies WHERE rowid = ?', [(rowid,) for rowid, _ in evicted])
+            connection.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('last_pruned', ?)", (str(now),)
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if force and evicted:
+            # Give the freed pages back
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            connection.execute('VACUUM')
+    finally:
+        connection.close()
+    log.info('Evicted %s entries, %s bytes, from %s', len(evicted), sum(size for _, size in evicted), cache_file)
+    return len(evicted), int(sum(size for _, size in evicted))
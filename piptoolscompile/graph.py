@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.graph
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Which requirement files each compiled requirements file depends on, and the other way around.
+
+    The inputs of a compiled requirements file are the ``.in`` file it was compiled from, its
+    ``--include`` files, formatted for the target's python version, and every requirements and
+    constraints file these reference, through ``-r``/``-c`` lines, recursively.
+
+    ``IncludeGraph`` persists them, per compiled requirements file, into a JSON file, with the paths
+    relative to its directory, so that ``--changed`` can tell which requirement files to compile
+    when some of those inputs change. The ``.in`` file itself is recorded as it was passed, so that
+    compiling it through ``--changed`` gives the same result as compiling it directly.
+'''
+
+# Import Python Libs
+import os
+import re
+import json
+import logging
+import functools
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+
+log = logging.getLogger(__name__)
+
+GRAPH_FORMAT = 2
+REFERENCE_RE = re.compile(r'^(?:-[rc]\s*|--(?:requirement|constraint)(?:\s*=\s*|\s+))(?P<path>\S.*)$')
+
+
+def parse_references(contents):
+    '''
+    Return the requirements and constraints files referenced from the requirements file ``contents``
+    '''
+    references = []
+    for line in contents.replace('\\\n', ' ').splitlines():
+        # Comments start the line, or follow whitespace
+        line = re.split(r'(?:^|\s)#', line, 1)[0].strip()
+        match = REFERENCE_RE.match(line)
+        if match and '://' not in match.group('path'):
+            references.append(match.group('path'))
+    return references
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_references(path, mtime_ns, size):  # pylint: disable=unused-argument
+    try:
+        with open(path) as rfh:
+            contents = rfh.read()
+    except (IOError, OSError):
+        return ()
+    return tuple(parse_references(contents))
+
+
+def get_references(path):
+    '''
+    Return the paths of the requirements files referenced by ``path``, joined to its directory
+    '''
+    try:
+        stat = os.stat(path)
+    except (IOError, OSError):
+        return ()
+    source_dir = os.path.dirname(path)
+    return tuple(
+        os.path.normpath(os.path.join(source_dir, reference))
+        for reference in _read_references(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    )
+
+
+def get_inputs(source, options):
+    '''
+    Return the inputs of ``source`` compiled for the target described by ``options``: ``source``
+    itself and its includes, as given, then every file they reference, relative to the file referencing it
+    '''
+    inputs = [source] + [include.format(py_version=options.py_version) for include in options.include]
+    seen = {os.path.abspath(fpath) for fpath in inputs}
+    pending = list(inputs)
+    while pending:
+        for reference in get_references(pending.pop(0)):
+            if os.path.abspath(reference) not in seen:
+                seen.add(os.path.abspath(reference))
+                inputs.append(reference)
+                pending.append(reference)
+    return inputs
+
+
+class IncludeGraph(object):
+    '''
+    The inputs of each compiled requirements file, persisted into the JSON file at ``path``
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._base_dir = os.path.dirname(os.path.abspath(path))
+        self._outputs = {}
+        self._dirty = False
+
+    def _relative(self, fpath):
+        return os.path.relpath(os.path.abspath(fpath), self._base_dir)
+
+    def _absolute(self, fpath):
+        return os.path.normpath(os.path.join(self._base_dir, fpath))
+
+    def load(self):
+        try:
+            with open(self.path) as rfh:
+                doc = json.load(rfh)
+        except (IOError, OSError):
+            return self
+        except ValueError:
+            log.warning('Ignoring the unreadable include graph %s', self.path)
+            return self
+        if doc.get('__format__') != GRAPH_FORMAT:
+            log.warning('Ignoring the include graph %s, written in another format', self.path)
+            return self
+        self._outputs = doc['outputs']
+        return self
+
+    def update(self, source, outfile_path, options):
+        '''
+        Record the inputs of ``outfile_path``, compiled from ``source`` for the target described by ``options``
+        '''
+        entry = {
+            'source': source,
+            'platform': options.platform,
+            'py_version': options.py_version,
+            'inputs': [self._relative(fpath) for fpath in get_inputs(source, options)],
+        }
+        key = self._relative(outfile_path)
+        if self._outputs.get(key) != entry:
+            self._outputs[key] = entry
+            self._dirty = True
+
+    def get_dependents(self):
+        '''
+        Return the reverse index, mapping the absolute path of each input to the compiled requirements
+        files depending on it
+        '''
+        dependents = {}
+        for outfile_path, entry in self._outputs.items():
+            for fpath in entry['inputs']:
+                dependents.setdefault(self._absolute(fpath), set()).add(outfile_path)
+        return dependents
+
+    def get_affected_sources(self, changed_files):
+        '''
+        Return the requirement files, still around, to compile again because of ``changed_files``,
+        as they were passed when last compiled
+        '''
+        dependents = self.get_dependents()
+        sources = []
+        for fpath in changed_files:
+            for outfile_path in sorted(dependents.get(os.path.abspath(fpath), ())):
+                source = self._outputs[outfile_path]['source']
+                if not os.path.exists(source):
+                    continue
+                if source not in sources:
+                    log.debug('%s depends on %s', outfile_path, fpath)
+                    sources.append(source)
+        return sources
+
+    def write(self):
+        if not self._dirty:
+            return
+        with piptoolscompile.utils.atomic_write(self.path) as wfh:
+            json.dump({'__format__': GRAPH_FORMAT, 'outputs': self._outputs}, wfh, indent=2, sort_keys=True)
+        self._dirty = False
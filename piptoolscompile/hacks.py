@@ -2,19 +2,21 @@ import os
 import sys
 import functools
 import logging
-from collections import namedtuple
 try:
     from unittest import mock
 except ImportError:
     import mock
 
-# Import pip-tools Libs
-# Keep a reference to the original DependencyCache class
-from piptools.cache import DependencyCache
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.depcache
+import piptoolscompile.timings
+from piptoolscompile import get_python_version_info
 
 # Import pip libs
 # We don't need Py2 vs Py3 encode/decode issues from pip
 import pip._internal.utils.misc
+import pip._internal.pep425tags
 real_version_info = sys.version_info
 
 # Let's import get_supported because we need the returned value from the un-mocked function
@@ -22,51 +24,114 @@ from pip._internal.pep425tags import get_supported
 
 log = logging.getLogger(__name__)
 
-version_info = namedtuple('version_info', ['major', 'minor', 'micro', 'releaselevel', 'serial'])
+
+def returns(value):
+    '''
+    Return a plain function which always returns ``value``.
+
+    Unlike ``mock.patch(..., return_value=value)``, calling it doesn't go through a ``MagicMock``,
+    nor does it record the call, which matters for the functions pip calls on every marker
+    evaluation and link it looks at.
+    '''
+    def constant(*args, **kwargs):
+        return value
+    return constant
+
+
+class SupportedTags(tuple):
+    '''
+    The supported wheel tags, in order of preference, with constant time ``in`` and ``index()``
+    lookups, which is what pip's candidate evaluation does for every wheel link it looks at.
+    '''
+
+    def __new__(cls, tags):
+        self = super(SupportedTags, cls).__new__(cls, tags)
+        priorities = {}
+        for priority, tag in enumerate(self):
+            # Like list.index, the first occurrence wins
+            priorities.setdefault(tag, priority)
+        self.priorities = priorities
+        return self
+
+    def __contains__(self, tag):
+        return tag in self.priorities
+
+    def index(self, tag, *args):
+        if args:
+            return super(SupportedTags, self).index(tag, *args)
+        try:
+            return self.priorities[tag]
+        except KeyError:
+            raise ValueError('{!r} is not a supported tag'.format(tag))
 
 
-class ImpersonateSystem(object):
+def wheel_supported(wheel, tags=None):
+    '''
+    Replacement for ``pip._internal.wheel.Wheel.supported`` which doesn't build a set out of all
+    the supported tags for every wheel it checks
+    '''
+    if tags is None:
+        tags = pip._internal.pep425tags.get_supported()
+    return any(tag in tags for tag in wheel.file_tags)
 
-    __slots__ = ('_python_version', '_python_version_info', '_platform')
+
+class ImpersonateSystem(piptoolscompile.utils.PatchingMixin):
+
+    __slots__ = ('_python_version', '_python_version_info', '_platform', '_patches', '_supported_tags')
 
     def __init__(self, python_version_info, platform):
         self._python_version = python_version_info
-        parts = [int(part) for part in python_version_info.split('.') if part.isdigit()]
-        python_version_info = list(sys.version_info)
-        for idx, part in enumerate(parts):
-            python_version_info[idx] = part
-        python_version_info = version_info(*python_version_info)
-        self._python_version_info = python_version_info
+        self._python_version_info = get_python_version_info(python_version_info)
         self._platform = platform
+        self._patches = []
+        self._supported_tags = {}
+
+    def get_supported(self, versions=None, noarch=False, platform=None, impl=None, abi=None):
+        '''
+        Memoized ``get_supported``, the tags only depend on the arguments and on the impersonated target
+        '''
+        key = (tuple(versions) if versions is not None else None, noarch, platform, impl, abi)
+        try:
+            return self._supported_tags[key]
+        except KeyError:
+            tags = SupportedTags(
+                get_supported_with_fixed_unicode_width(
+                    versions=versions, noarch=noarch, platform=platform, impl=impl, abi=abi
+                )
+            )
+            self._supported_tags[key] = tags
+            return tags
 
     def get_mocks(self):
-        yield mock.patch('pip._internal.utils.misc.sys.version_info',
-                         new_callable=mock.PropertyMock(return_value=real_version_info))
+        # All patches replace the targets with plain values, no mock objects get involved
+        yield mock.patch('pip._internal.utils.misc.sys.version_info', new=real_version_info)
         yield mock.patch('piptools.scripts.compile.DependencyCache',
-                         wraps=functools.partial(tweak_piptools_depcache_filename,
-                                                 self._python_version_info,
-                                                 self._platform))
+                         new=functools.partial(tweak_piptools_depcache_filename,
+                                               self._python_version_info,
+                                               self._platform))
         yield mock.patch('pip._internal.pep425tags.get_impl_version_info',
-                         return_value=self._python_version_info[:2])
-        yield mock.patch('pip._internal.utils.packaging.sys.version_info',
-                         new_callable=mock.PropertyMock(return_value=self._python_version_info))
+                         new=returns(self._python_version_info[:2]))
+        yield mock.patch('pip._internal.utils.packaging.sys.version_info', new=self._python_version_info)
         yield mock.patch('pip._vendor.packaging.markers.platform.python_version',
-                         return_value='{}.{}.{}'.format(*self._python_version_info))
+                         new=returns('{}.{}.{}'.format(*self._python_version_info)))
+        yield mock.patch('pip._internal.wheel.Wheel.supported', new=wheel_supported)
+        yield mock.patch('pip._internal.download._copy_file', new=piptoolscompile.utils.copy_file_atomically)
 
     def get_global_mocks(self):
         raise StopIteration
 
     def __enter__(self):
-        os.environ["IMPERSONATE_PLATFORM"] = self._platform
-        os.environ["IMPERSONATE_PY_VERSION"] = self._python_version
-        for mock_obj in self.get_mocks():
-            mock_obj.start()
+        with piptoolscompile.timings.phase('impersonation_enter', target=(self._platform, self._python_version)):
+            os.environ["IMPERSONATE_PLATFORM"] = self._platform
+            os.environ["IMPERSONATE_PY_VERSION"] = self._python_version
+            self.start_patches()
         return self
 
     def __exit__(self, *args):
-        os.environ.pop("IMPERSONATE_PLATFORM")
-        os.environ.pop("IMPERSONATE_PY_VERSION")
-        mock.patch.stopall()
+        with piptoolscompile.timings.phase('impersonation_exit', target=(self._platform, self._python_version)):
+            os.environ.pop("IMPERSONATE_PLATFORM")
+            os.environ.pop("IMPERSONATE_PY_VERSION")
+            self.stop_patches(*args)
 
 
 def get_supported_with_fixed_unicode_width(*args, **kwargs):
@@ -78,12 +143,7 @@ def get_supported_with_fixed_unicode_width(*args, **kwargs):
 
 
 def tweak_piptools_depcache_filename(version_info, platform, *args, **kwargs):
-    depcache = DependencyCache(*args, **kwargs)
-    cache_file = os.path.join(os.path.dirname(depcache._cache_file),
-                              'depcache-{}-py{}.{}.json'.format(platform, *version_info))
-    log.info('Tweaking the pip-tools depcache file to: %s', cache_file)
-    depcache._cache_file = cache_file
-    return depcache
+    return piptoolscompile.depcache.get_dependency_cache(version_info, platform, *args, **kwargs)
 
 
 class ImpersonateWindows(ImpersonateSystem):
@@ -92,19 +152,19 @@ class ImpersonateWindows(ImpersonateSystem):
         for entry in super(ImpersonateWindows, self).get_mocks():
             yield entry
         # We don't want pip trying query python's internals, it knows how to mock that internal information
-        yield mock.patch('pip._internal.pep425tags.get_config_var', return_value=None)
+        yield mock.patch('pip._internal.pep425tags.get_config_var', new=returns(None))
         # Impersonate Windows 32
-        yield mock.patch('pip._internal.pep425tags.get_platform', return_value='win32')
-        # Wrap get_supported in out own function call to fix unicode width issues
-        yield mock.patch('pip._internal.pep425tags.get_supported', wraps=get_supported_with_fixed_unicode_width)
-        yield mock.patch('pip._internal.index.get_supported', wraps=get_supported_with_fixed_unicode_width)
+        yield mock.patch('pip._internal.pep425tags.get_platform', new=returns('win32'))
+        # Serve get_supported from our own memoized tags, which fix unicode width issues
+        yield mock.patch('pip._internal.pep425tags.get_supported', new=self.get_supported)
+        yield mock.patch('pip._internal.index.get_supported', new=self.get_supported)
         # Patch pip's vendored packaging markers
-        yield mock.patch('pip._vendor.packaging.markers.os.name', new_callable=mock.PropertyMock(return_value='nt'))
-        yield mock.patch('pip._vendor.packaging.markers.sys.platform', new_callable=mock.PropertyMock(return_value='win32'))
-        yield mock.patch('pip._vendor.packaging.markers.platform.machine', return_value='AMD64')
-        yield mock.patch('pip._vendor.packaging.markers.platform.release', return_value='8.1')
-        yield mock.patch('pip._vendor.packaging.markers.platform.system', return_value='Windows')
-        yield mock.patch('pip._vendor.packaging.markers.platform.version', return_value='6.3.9600')
+        yield mock.patch('pip._vendor.packaging.markers.os.name', new='nt')
+        yield mock.patch('pip._vendor.packaging.markers.sys.platform', new='win32')
+        yield mock.patch('pip._vendor.packaging.markers.platform.machine', new=returns('AMD64'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.release', new=returns('8.1'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.system', new=returns('Windows'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.version', new=returns('6.3.9600'))
 
 
 class ImpersonateDarwin(ImpersonateSystem):
@@ -132,21 +192,21 @@ class ImpersonateDarwin(ImpersonateSystem):
         for entry in super(ImpersonateDarwin, self).get_mocks():
             yield entry
         # We don't want pip trying query python's internals, it knows how to mock that internal information
-        yield mock.patch('pip._internal.pep425tags.get_config_var', return_value=None)
+        yield mock.patch('pip._internal.pep425tags.get_config_var', new=returns(None))
         # Impersonate Windows 32
-        yield mock.patch('pip._internal.pep425tags.get_platform', return_value='macosx_10_15_x86_64')
-        # Wrap get_supported in out own function call to fix unicode width issues
-        yield mock.patch('pip._internal.pep425tags.get_supported', wraps=get_supported_with_fixed_unicode_width)
-        yield mock.patch('pip._internal.index.get_supported', wraps=get_supported_with_fixed_unicode_width)
+        yield mock.patch('pip._internal.pep425tags.get_platform', new=returns('macosx_10_15_x86_64'))
+        # Serve get_supported from our own memoized tags, which fix unicode width issues
+        yield mock.patch('pip._internal.pep425tags.get_supported', new=self.get_supported)
+        yield mock.patch('pip._internal.index.get_supported', new=self.get_supported)
         # Patch pip's vendored packaging markers
-        yield mock.patch('pip._vendor.packaging.markers.os.name', new_callable=mock.PropertyMock(return_value='posix'))
-        yield mock.patch('pip._vendor.packaging.markers.sys.platform', new_callable=mock.PropertyMock(return_value='darwin'))
-        yield mock.patch('pip._vendor.packaging.markers.platform.machine', return_value='x86_64')
-        yield mock.patch('pip._vendor.packaging.markers.platform.release', return_value='19.3.0')
-        yield mock.patch('pip._vendor.packaging.markers.platform.system', return_value='Darwin')
+        yield mock.patch('pip._vendor.packaging.markers.os.name', new='posix')
+        yield mock.patch('pip._vendor.packaging.markers.sys.platform', new='darwin')
+        yield mock.patch('pip._vendor.packaging.markers.platform.machine', new=returns('x86_64'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.release', new=returns('19.3.0'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.system', new=returns('Darwin'))
         yield mock.patch('pip._vendor.packaging.markers.platform.version',
-                         return_value='Darwin Kernel Version 19.3.0: Thu Jan  9 20:58:23 PST 2020; root:xnu-6153.81.5~1/RELEASE_X86_64')
-        yield mock.patch('pip._vendor.packaging.markers.platform.python_version', return_value='{}.{}.{}'.format(*self._python_version_info))
+                         new=returns('Darwin Kernel Version 19.3.0: Thu Jan  9 20:58:23 PST 2020; root:xnu-6153.81.5~1/RELEASE_X86_64'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.python_version', new=returns('{}.{}.{}'.format(*self._python_version_info)))
 
     def get_global_mocks(self):
         #yield mock.patch('sys.platform', new_callable=mock.PropertyMock(return_value='darwin'))
@@ -159,21 +219,21 @@ class ImpersonateLinux(ImpersonateSystem):
         for entry in super(ImpersonateLinux, self).get_mocks():
             yield entry
         # We don't want pip trying query python's internals, it knows how to mock that internal information
-        yield mock.patch('pip._internal.pep425tags.get_config_var', return_value=None)
+        yield mock.patch('pip._internal.pep425tags.get_config_var', new=returns(None))
         # Impersonate Windows 32
-        yield mock.patch('pip._internal.pep425tags.get_platform', return_value='linux2')
-        # Wrap get_supported in out own function call to fix unicode width issues
-        yield mock.patch('pip._internal.pep425tags.get_supported', wraps=get_supported_with_fixed_unicode_width)
-        yield mock.patch('pip._internal.index.get_supported', wraps=get_supported_with_fixed_unicode_width)
+        yield mock.patch('pip._internal.pep425tags.get_platform', new=returns('linux2'))
+        # Serve get_supported from our own memoized tags, which fix unicode width issues
+        yield mock.patch('pip._internal.pep425tags.get_supported', new=self.get_supported)
+        yield mock.patch('pip._internal.index.get_supported', new=self.get_supported)
         # Patch pip's vendored packaging markers
         yield mock.patch('pip._vendor.packaging.markers.sys.platform',
-                         new_callable=mock.PropertyMock(return_value='linux{}'.format('2' if self._python_version_info[0] == 2 else '')))
-        yield mock.patch('pip._vendor.packaging.markers.os.name', new_callable=mock.PropertyMock(return_value='posix'))
-        yield mock.patch('pip._vendor.packaging.markers.platform.machine', return_value='x86_64')
-        yield mock.patch('pip._vendor.packaging.markers.platform.release', return_value='4.19.29-1-lts')
-        yield mock.patch('pip._vendor.packaging.markers.platform.system', return_value='Linux')
-        yield mock.patch('pip._vendor.packaging.markers.platform.version', return_value='#1 SMP Thu Mar 14 15:39:08 CET 2019')
-        yield mock.patch('pip._vendor.packaging.markers.platform.python_version', return_value='{}.{}.{}'.format(*self._python_version_info))
+                         new='linux{}'.format('2' if self._python_version_info[0] == 2 else ''))
+        yield mock.patch('pip._vendor.packaging.markers.os.name', new='posix')
+        yield mock.patch('pip._vendor.packaging.markers.platform.machine', new=returns('x86_64'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.release', new=returns('4.19.29-1-lts'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.system', new=returns('Linux'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.version', new=returns('#1 SMP Thu Mar 14 15:39:08 CET 2019'))
+        yield mock.patch('pip._vendor.packaging.markers.platform.python_version', new=returns('{}.{}.{}'.format(*self._python_version_info)))
 
 IMPERSONATIONS = {
     'darwin': ImpersonateDarwin,
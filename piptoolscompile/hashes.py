@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.hashes
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Artifact hashes cache shared between all impersonated targets, for ``--generate-hashes``.
+
+    pip-tools downloads and hashes every artifact of every pinned version, for every target, even
+    though an artifact's hash does not depend on the target. Here, an artifact's sha256 comes, in
+    order of preference, from:
+
+    * the ``#sha256=`` fragment of its index link;
+    * the artifact hashes cache, keyed by the artifact URL, stored in pip-tools' cache directory;
+    * the copy pip downloaded while resolving, or the local file for ``file://`` links;
+    * downloading it, several artifacts at once.
+
+    Each cache entry carries a checksum of its own contents, and, for local files, their size and
+    modification time. An entry which does not check out gets hashed again rather than ending up in
+    a compiled requirements file.
+'''
+
+# Import Python Libs
+import os
+import re
+import json
+import hashlib
+import logging
+import concurrent.futures
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+# Number of artifacts downloaded and hashed at once
+HASH_THREADS = 8
+CHUNK_SIZE = 1024 * 1024
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_entry_checksum(url, entry):
+    '''
+    The checksum of the hashes cache ``entry`` of ``url``
+    '''
+    contents = json.dumps([url, entry.get('sha256'), entry.get('size'), entry.get('mtime')])
+    return hashlib.sha256(contents.encode('utf-8')).hexdigest()
+
+
+def hash_file(path):
+    '''
+    Return the sha256 hex digest of the file at ``path``
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as rfh:
+        for chunk in iter(lambda: rfh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_remote_file(session, url):
+    '''
+    Download the file at ``url`` through the requests ``session`` and return its sha256 hex digest and size
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    response = session.get(url, headers={'Accept-Encoding': 'identity'}, stream=True)
+    try:
+        response.raise_for_status()
+        for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        expected_size = response.headers.get('Content-Length')
+    finally:
+        response.close()
+    if expected_size is not None and expected_size.isdigit() and int(expected_size) != size:
+        raise IOError('Got {} bytes instead of {} from {}'.format(size, expected_size, url))
+    return digest.hexdigest(), size
+
+
+class HashCache(object):
+    '''
+    On disk ``artifact URL -> sha256`` mapping
+    '''
+
+    def __init__(self, cache_dir, filename='artifact-hashes.json'):
+        self._cache_file = os.path.join(cache_dir, filename)
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = self.read_cache()
+        return self._cache
+
+    def read_cache(self):
+        if not os.path.exists(self._cache_file):
+            return {}
+        try:
+            with open(self._cache_file) as rfh:
+                doc = json.load(rfh)
+        except ValueError:
+            log.warning('Ignoring corrupted artifact hashes cache file %s', self._cache_file)
+            return {}
+        if not isinstance(doc, dict) or doc.get('__format__') != 1 or not isinstance(doc.get('hashes'), dict):
+            return {}
+        return doc['hashes']
+
+    def write_cache(self):
+        # Merge what other processes might have written in the meantime
+        cache = self.read_cache()
+        cache.update(self.cache)
+        self._cache = cache
+        with piptoolscompile.utils.atomic_write(self._cache_file) as wfh:
+            json.dump({'__format__': 1, 'hashes': cache}, wfh, sort_keys=True)
+
+    def get(self, url, stat=None):
+        '''
+        Return the cached sha256 of ``url``, or ``None``. ``stat`` is the ``os.stat`` result of local files
+        '''
+        entry = self.cache.get(url)
+        if entry is None:
+            return None
+        if not isinstance(entry, dict) \
+                or not SHA256_RE.match(str(entry.get('sha256'))) \
+                or entry.get('check') != get_entry_checksum(url, entry):
+            log.warning('Ignoring the corrupted artifact hashes cache entry of %s', url)
+            piptoolscompile.timings.count('artifact_hashes_corrupted')
+            del self.cache[url]
+            return None
+        if stat is not None and (entry.get('size'), entry.get('mtime')) != (stat.st_size, stat.st_mtime_ns):
+            # The local file changed since it was hashed
+            return None
+        return entry['sha256']
+
+    def set(self, url, sha256, size=None, mtime=None):
+        entry = {'sha256': sha256, 'size': size, 'mtime': mtime}
+        entry['check'] = get_entry_checksum(url, entry)
+        self.cache[url] = entry
+
+
+class SharedHashes(piptoolscompile.utils.PatchingMixin):
+    '''
+    Serve ``Resolver.resolve_hashes`` from the artifact hashes cache, hashing what is missing from it
+    ``HASH_THREADS`` artifacts at a time
+    '''
+
+    def __init__(self):
+        self._caches = {}
+        self._patches = []
+        self.hits = self.misses = 0
+
+    def get_cache(self, cache_dir):
+        if cache_dir not in self._caches:
+            self._caches[cache_dir] = HashCache(cache_dir)
+        return self._caches[cache_dir]
+
+    @staticmethod
+    def get_links(repository, ireq):
+        '''
+        Return the links of the artifacts of the pinned ``ireq``, the ones ``PyPIRepository.get_hashes``
+        hashes, or ``None`` when it's not a pinned requirement from an index
+        '''
+        from piptools.utils import is_pinned_requirement
+
+        if ireq.link or ireq.editable or not is_pinned_requirement(ireq):
+            return None
+        all_candidates = repository.find_all_candidates(ireq.name)
+        matching_versions = list(ireq.specifier.filter(candidate.version for candidate in all_candidates))
+        if not matching_versions:
+            return None
+        return [
+            getattr(candidate, 'link', None) or candidate.location
+            for candidate in all_candidates
+            if candidate.version == matching_versions[0]
+        ]
+
+    def get_local_path(self, repository, link):
+        if link.scheme == 'file':
+            from pip._internal.download import url_to_path
+            return url_to_path(link.url_without_fragment)
+        # Downloaded by pip while resolving
+        for download_dir in (repository._download_dir, repository._wheel_download_dir):
+            path = os.path.join(download_dir, link.filename)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def hash_links(self, repository, links):
+        '''
+        Return the sha256 hex digests of ``links``, by URL
+        '''
+        cache = self.get_cache(repository._cache_dir)
+        digests = {}
+        pending = []
+        seen = set()
+        for link in links:
+            url = link.url_without_fragment
+            if url in seen:
+                continue
+            seen.add(url)
+            if link.hash_name == 'sha256' and SHA256_RE.match(link.hash):
+                digests[url] = link.hash
+                piptoolscompile.timings.count('artifact_hashes_from_index')
+                continue
+            path = self.get_local_path(repository, link)
+            stat = None
+            if link.scheme == 'file':
+                try:
+                    stat = os.stat(path)
+                except (IOError, OSError):
+                    path = None
+            digest = cache.get(url, stat)
+            if digest is not None:
+                self.hits += 1
+                piptoolscompile.timings.count('artifact_hash_hits')
+                digests[url] = digest
+                continue
+            self.misses += 1
+            piptoolscompile.timings.count('artifact_hash_misses')
+            pending.append((url, path, stat))
+
+        def compute(url, path, stat):
+            if path is not None:
+                log.debug('Hashing %s', path)
+                return hash_file(path), None
+            log.debug('Downloading and hashing %s', url)
+            return hash_remote_file(repository.session, url)
+
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(HASH_THREADS, len(pending))) as executor:
+                futures = [(url, stat, executor.submit(compute, url, path, stat)) for url, path, stat in pending]
+                for url, stat, future in futures:
+                    digest, size = future.result()
+                    digests[url] = digest
+                    if stat is not None:
+                        cache.set(url, digest, stat.st_size, stat.st_mtime_ns)
+                    else:
+                        cache.set(url, digest, size)
+            cache.write_cache()
+        return digests
+
+    def resolve_hashes(self, resolver, ireqs):
+        from pip._internal.utils.hashes import FAVORITE_HASH
+
+        # Unwrap the LocalRequirementsRepository proxy
+        repository = getattr(resolver.repository, 'repository', resolver.repository)
+        hashes = {}
+        with repository.allow_all_wheels():
+            links = {}
+            for ireq in ireqs:
+                ireq_links = self.get_links(repository, ireq)
+                if ireq_links is None:
+                    hashes[ireq] = repository.get_hashes(ireq)
+                else:
+                    links[ireq] = ireq_links
+            digests = self.hash_links(repository, [link for ireq_links in links.values() for link in ireq_links])
+        for ireq, ireq_links in links.items():
+            hashes[ireq] = {
+                '{}:{}'.format(FAVORITE_HASH, digests[link.url_without_fragment]) for link in ireq_links
+            }
+        return hashes
+
+    def get_mocks(self):
+        state = self
+
+        def resolve_hashes(resolver, ireqs):
+            with piptoolscompile.timings.phase('artifact_hashing'):
+                return state.resolve_hashes(resolver, ireqs)
+
+        yield mock.patch('piptools.resolver.Resolver.resolve_hashes', new=resolve_hashes)
+
+    def __exit__(self, *args):
+        self.stop_patches(*args)
+        log.debug('Artifact hashes cache hits: %s, misses: %s', self.hits, self.misses)
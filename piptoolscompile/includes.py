@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.includes
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The ``--include`` files, with the ``--passthrough-line-from-input`` lines taken out, preprocessed
+    once per run instead of once per compiled requirements file.
+
+    The rewritten files are named after what they were preprocessed from, and live in a directory
+    created when the run starts, and removed when it ends. Worker processes forked during the run
+    share it.
+'''
+
+# Import Python Libs
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+
+class PreprocessedIncludes(object):
+    '''
+    Cache of the preprocessed ``--include`` files, keyed by path, modification time and regexes
+    '''
+
+    # The cache of the current run
+    current = None
+
+    def __init__(self):
+        self._directory = None
+        self._previous = None
+        self._cache = {}
+
+    def __enter__(self):
+        self._directory = tempfile.mkdtemp(prefix='pip-tools-compile-includes-')
+        self._previous = PreprocessedIncludes.current
+        PreprocessedIncludes.current = self
+        return self
+
+    def __exit__(self, *args):
+        PreprocessedIncludes.current = self._previous
+        self._previous = None
+        self._cache.clear()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def get(self, input_file, regexes):
+        '''
+        Return the path to pass to pip-compile instead of ``input_file``, and the lines of
+        ``input_file`` matching any of the ``regexes``, taken out of it
+        '''
+        stat = os.stat(input_file)
+        key = (os.path.abspath(input_file), stat.st_mtime_ns, stat.st_size, tuple(regex.pattern for regex in regexes))
+        if key not in self._cache:
+            with piptoolscompile.timings.phase('include_preprocessing'):
+                self._cache[key] = self.preprocess(input_file, regexes, key)
+        else:
+            log.debug('Reusing the preprocessed %s', input_file)
+            piptoolscompile.timings.count('include_cache_hits')
+        return self._cache[key]
+
+    def preprocess(self, input_file, regexes, key):
+        out_contents = []
+        passthrough_lines = []
+        with open(input_file) as rfh:
+            for line in rfh.read().splitlines():
+                if any(regex.match(line) for regex in regexes):
+                    passthrough_lines.append(line)
+                else:
+                    out_contents.append(line)
+        if not passthrough_lines:
+            return input_file, passthrough_lines
+
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:16]
+        rewriten_file = os.path.join(self._directory, '{}-{}'.format(digest, os.path.basename(input_file)))
+        if not os.path.exists(rewriten_file):
+            # Worker processes share the directory, never let one see a partially written file
+            with piptoolscompile.utils.atomic_write(rewriten_file) as wfh:
+                for line in out_contents:
+                    wfh.write('{}\n'.format(line))
+        return rewriten_file, passthrough_lines
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.incremental
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Re-resolve only what changed since the requirements file was last compiled.
+
+    The last compiled requirements file records every pin, along with, through its ``# via``
+    annotations, the dependency graph between them. Before the pip-tools resolver starts, the
+    primary requirements it got are compared against it. The roots of the re-resolution are:
+
+    * the primary requirements which are not pinned yet, or whose pin no longer satisfies them;
+    * the primary requirements which cannot be compared, editable or URL requirements;
+    * the ``--upgrade-package`` pins, which pip-tools left out of the existing pins.
+
+    Every pin reachable from a root might change, as might the requirements of any pin depending on
+    one of those, the resolver looks them up as usual. The remaining pins are kept fixed: their
+    dependencies are served, from memory, as the pins of their children in the last compiled
+    requirements file, without looking up any index page, wheel or source distribution. These
+    entries are never written to the dependency cache.
+
+    A compiled requirements file without those annotations, compiled with ``--no-annotate``, does
+    not record the dependencies of its pins, and gets resolved again from scratch.
+
+    Whenever the resolver fails, the requirements get resolved again, from scratch.
+'''
+
+# Import Python Libs
+import os
+import re
+import logging
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+PIN_RE = re.compile(
+    r'^(?P<name>[A-Za-z0-9._-]+)(?P<extras>\[[^\]]*\])?==(?P<version>[^\s;#]+)(?:[^#]*#\s*via\s+(?P<via>.*))?$'
+)
+UNSAFE_HEADER = '# The following packages are considered to be unsafe'
+
+
+def get_key(name):
+    '''
+    The key pip-tools uses for the project ``name``
+    '''
+    return name.replace('_', '-').lower()
+
+
+class Pin(object):
+    '''
+    A pin of a compiled requirements file
+    '''
+
+    def __init__(self, name, extras, version, parents, unsafe):
+        self.name = name
+        self.extras = extras
+        self.version = version
+        # The keys of the pins depending on it, or ``None`` if it was not annotated
+        self.parents = parents
+        # Whether it was commented out, as an unsafe package
+        self.unsafe = unsafe
+
+    @property
+    def key(self):
+        return get_key(self.name)
+
+    @property
+    def requirement(self):
+        extras = '[{}]'.format(','.join(self.extras)) if self.extras else ''
+        return '{}{}=={}'.format(self.name, extras, self.version)
+
+    @property
+    def cache_key(self):
+        '''
+        The key of the pin's entry in pip-tools' dependency cache
+        '''
+        extras = '[{}]'.format(','.join(self.extras)) if self.extras else ''
+        return self.key, '{}{}'.format(self.version, extras)
+
+
+def read_lockfile(path):
+    '''
+    Return the pins of the compiled requirements file at ``path``, by key, or ``None`` if it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as rfh:
+        contents = rfh.read()
+    pins = {}
+    unsafe = False
+    # With --generate-hashes, the hashes, then the annotation, follow the pin on continuation lines
+    for line in re.sub(r'\\\n\s*', ' ', contents).splitlines():
+        if line.startswith(UNSAFE_HEADER):
+            unsafe = True
+            continue
+        if unsafe and line.startswith('# '):
+            line = line[2:]
+        match = PIN_RE.match(line)
+        if match is None:
+            continue
+        extras = match.group('extras')
+        extras = tuple(sorted(get_key(extra.strip()) for extra in extras[1:-1].split(',') if extra.strip())) \
+            if extras else ()
+        parents = None
+        if match.group('via') is not None:
+            parents = set()
+            for parent in match.group('via').split(','):
+                parent = parent.strip()
+                # Primary requirements are annotated with the file requiring them, "-r <path> (line <n>)"
+                if parent and not parent.startswith('-'):
+                    parents.add(get_key(parent))
+        pin = Pin(match.group('name'), extras, match.group('version'), parents, unsafe)
+        pins[pin.key] = pin
+    return pins
+
+
+class IncrementalResolution(piptoolscompile.utils.PatchingMixin):
+    '''
+    Keep the pins of the compiled requirements file at ``path`` which are not affected by the
+    changes fixed, while pip-compile resolves
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.pins = None
+        self.affected = None
+        self._patches = []
+
+    def get_roots(self, resolver):
+        '''
+        Return the keys of the roots of the re-resolution, or ``None`` when the last compiled
+        requirements cannot be built upon
+        '''
+        from piptools.repositories.local import LocalRequirementsRepository
+        from piptools.utils import key_from_ireq
+
+        repository = resolver.repository
+        # pip-tools only keeps the existing pins when not upgrading every package
+        if not isinstance(repository, LocalRequirementsRepository) or resolver.clear_caches:
+            return None
+        roots = set()
+        for ireq in resolver.our_constraints:
+            if ireq.editable or ireq.link or not ireq.name:
+                roots.add(key_from_ireq(ireq) if ireq.name else None)
+                continue
+            key = key_from_ireq(ireq)
+            pin = self.pins.get(key)
+            if pin is None:
+                if not ireq.constraint:
+                    roots.add(key)
+                continue
+            if not ireq.specifier.contains(pin.version, prereleases=True) or \
+                    not {get_key(extra) for extra in ireq.extras}.issubset(pin.extras):
+                roots.add(key)
+        # The --upgrade-package pins
+        for key, pin in self.pins.items():
+            if not pin.unsafe and key not in repository.existing_pins:
+                roots.add(key)
+        roots.discard(None)
+        return roots
+
+    def get_affected(self, roots):
+        '''
+        Return the keys of the pins reachable from ``roots``, and of the pins depending on any of those
+        '''
+        children = {}
+        for key, pin in self.pins.items():
+            for parent in pin.parents:
+                children.setdefault(parent, set()).add(key)
+
+        def walk(keys, edges):
+            seen = set(keys)
+            pending = list(keys)
+            while pending:
+                for key in edges.get(pending.pop(), ()):
+                    if key not in seen:
+                        seen.add(key)
+                        pending.append(key)
+            return seen
+
+        affected = walk(roots, children)
+        return walk(affected, {key: pin.parents for key, pin in self.pins.items()})
+
+    def fix_pins(self, resolver):
+        '''
+        Seed the dependency cache of ``resolver`` with the dependencies of the fixed pins. Return the
+        seeded entries, or ``None`` when incremental resolution does not apply
+        '''
+        import piptoolscompile.depcache
+
+        depcache = resolver.dependency_cache
+        # Anything else than the SQLite dependency cache writes every entry it holds out
+        if not isinstance(depcache, piptoolscompile.depcache.SQLiteDependencyCache):
+            log.info('Incremental resolution requires the SQLite dependency cache')
+            return None
+        self.pins = read_lockfile(self.path)
+        if not self.pins:
+            return None
+        if any(pin.parents is None for pin in self.pins.values()):
+            # Every pin is annotated, unless compiled with --no-annotate
+            print('  Incremental: {} lacks "# via" annotations, resolving from scratch'.format(self.path))
+            return None
+        roots = self.get_roots(resolver)
+        if roots is None:
+            return None
+        self.affected = self.get_affected(roots)
+        children = {}
+        for key, pin in self.pins.items():
+            for parent in pin.parents:
+                children.setdefault(parent, []).append(pin)
+        seeded = []
+        for key, pin in self.pins.items():
+            if key in self.affected:
+                continue
+            name, version = pin.cache_key
+            versions = depcache.cache.setdefault(name, {})
+            # What was actually looked up before comes first
+            if version in versions or depcache.lookup(name, version) is not None:
+                continue
+            versions[version] = sorted(child.requirement for child in children.get(key, ()))
+            seeded.append((name, version))
+        print('  Incremental: keeping {} of {} pins fixed'.format(len(seeded), len(self.pins)))
+        log.info('Re-resolving %s, keeping the other pins of %s fixed', sorted(self.affected), self.path)
+        piptoolscompile.timings.count('incremental_fixed_pins', len(seeded))
+        return seeded
+
+    def get_mocks(self):
+        import piptools.resolver
+        from piptools.exceptions import PipToolsError
+        state = self
+        real_resolve = piptools.resolver.Resolver.resolve
+
+        def resolve(resolver, *args, **kwargs):
+            seeded = state.fix_pins(resolver)
+            if not seeded:
+                return real_resolve(resolver, *args, **kwargs)
+            try:
+                return real_resolve(resolver, *args, **kwargs)
+            except (PipToolsError, RuntimeError) as exc:
+                print('  Incremental: {}, resolving from scratch'.format(exc))
+                log.info('Incremental resolution failed, resolving from scratch', exc_info=True)
+                piptoolscompile.timings.count('incremental_fallbacks')
+            for name, version in seeded:
+                resolver.dependency_cache.cache[name].pop(version, None)
+            resolver.their_constraints = set()
+            return real_resolve(resolver, *args, **kwargs)
+
+        yield mock.patch('piptools.resolver.Resolver.resolve', new=resolve)
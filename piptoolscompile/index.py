@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.index
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Index state shared between the impersonated targets compiled by a single process
+
+    The index pages of the projects a requirements file is known to need, the ones it and its
+    inputs name, along with the ones pinned by its last compile, get fetched ahead of time, by a
+    bounded pool of threads, as soon as pip-compile starts looking for candidates. The resolver then
+    finds them fetched already, or waits for the fetch in flight, instead of fetching them one
+    after the other as it discovers them. requests sessions are not thread safe, each prefetching
+    thread uses a session of its own, built the same way as the one of the ``PackageFinder``.
+'''
+
+# Import Python Libs
+import re
+import logging
+import threading
+import concurrent.futures
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+# How many index pages to fetch at once, ahead of time
+PREFETCH_THREADS = 8
+PROJECT_NAME_RE = re.compile(r'^(?P<name>[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)')
+
+
+def get_project_names(fpaths):
+    '''
+    Return the names of the projects required by the requirement files ``fpaths``, skipping the
+    ones which cannot be read
+    '''
+    names = []
+    for fpath in fpaths:
+        try:
+            with open(fpath) as rfh:
+                lines = rfh.read().replace('\\\n', ' ').splitlines()
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            line = re.split(r'(?:^|\s)#', line, 1)[0].strip()
+            if not line or line.startswith('-') or '://' in line:
+                continue
+            match = PROJECT_NAME_RE.match(line)
+            if match and match.group('name') not in names:
+                names.append(match.group('name'))
+    return names
+
+
+class SharedIndexState(piptoolscompile.utils.PatchingMixin):
+    '''
+    Keep the pip HTTP sessions and the fetched index pages around while compiling several
+    targets in the same process.
+
+    Neither of these depend on the impersonated platform or python version, the candidate
+    filtering which does, happens afterwards, inside pip's ``PackageFinder``.
+    '''
+
+    # The index state of the current process
+    current = None
+
+    def __init__(self):
+        self._sessions = {}
+        self._pages = {}
+        self._patches = []
+        self._previous = None
+        self._real_get_html_page = None
+        self._real_build_session = None
+        self._real_find_all_candidates = None
+        # The projects to prefetch the index pages of, once a PackageFinder is around
+        self._pending = []
+        self._prefetch_threads = PREFETCH_THREADS
+        self._executor = None
+        # The index pages being prefetched, by URL
+        self._prefetching = {}
+        self._lock = threading.Lock()
+        # How each session was built, by id, to build the same sessions in the prefetching threads
+        self._session_args = {}
+        self._local = threading.local()
+        self._thread_sessions = []
+
+    @staticmethod
+    def _session_key(options, retries, timeout):
+        return (
+            options.cache_dir,
+            retries if retries is not None else options.retries,
+            timeout if timeout is not None else options.timeout,
+            tuple(options.trusted_hosts or ()),
+            options.cert,
+            options.client_cert,
+            options.proxy,
+            options.no_input,
+        )
+
+    def build_session(self, command, options, retries=None, timeout=None):
+        key = self._session_key(options, retries, timeout)
+        if key not in self._sessions:
+            session = self._real_build_session(command, options, retries=retries, timeout=timeout)
+            self._sessions[key] = session
+            self._session_args[id(session)] = (key, command, options, retries, timeout)
+        else:
+            log.debug('Reusing previously built pip session')
+        return self._sessions[key]
+
+    def get_html_page(self, link, session=None):
+        url = link.url.split('#', 1)[0]
+        if url in self._pages:
+            log.debug('Reusing previously fetched index page %s', url)
+            piptoolscompile.timings.count('index_pages_reused')
+            return self._pages[url]
+        with self._lock:
+            future = self._prefetching.pop(url, None)
+        if future is not None:
+            with piptoolscompile.timings.phase('index_prefetch_wait'):
+                page = future.result()
+            if page is not None:
+                log.debug('Using the prefetched index page %s', url)
+                piptoolscompile.timings.count('index_pages_prefetched')
+                self._pages[url] = page
+                return page
+        piptoolscompile.timings.count('index_pages_fetched')
+        with piptoolscompile.timings.phase('index_fetch'):
+            page = self._fetch_page(link, session)
+        if page is not None:
+            self._pages[url] = page
+        return page
+
+    def _get_thread_session(self, session):
+        '''
+        Return the session the current prefetching thread uses instead of ``session``, or ``None``
+        if it was not built through ``build_session``
+        '''
+        if id(session) not in self._session_args:
+            return None
+        key, command, options, retries, timeout = self._session_args[id(session)]
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = self._local.sessions = {}
+        if key not in sessions:
+            sessions[key] = self._real_build_session(command, options, retries=retries, timeout=timeout)
+            with self._lock:
+                self._thread_sessions.append(sessions[key])
+        return sessions[key]
+
+    def _prefetch_page(self, link, session):
+        thread_session = self._get_thread_session(session)
+        if thread_session is None:
+            log.debug('Not prefetching %s, its session was not built by pip-tools-compile', link)
+            return None
+        return self._fetch_page(link, thread_session)
+
+    def _fetch_page(self, link, session):
+        page = self._real_get_html_page(link, session=session)
+        if page is not None:
+            # Parsing the page is as expensive as fetching it from the HTTP cache, do it only once
+            page.iter_links = CachedLinks(page.iter_links)
+        return page
+
+    def prefetch(self, project_names, threads=PREFETCH_THREADS):
+        '''
+        Fetch the index pages of ``project_names``, ``threads`` at a time, as soon as pip looks for
+        the candidates of any project
+        '''
+        self._pending = list(project_names)
+        self._prefetch_threads = threads
+
+    def find_all_candidates(self, finder, project_name):
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self._start_prefetching(finder, pending)
+        return self._real_find_all_candidates(finder, project_name)
+
+    def _start_prefetching(self, finder, project_names):
+        from pip._internal.index import Link
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._prefetch_threads)
+        for project_name in project_names:
+            for url in finder._get_index_urls_locations(project_name):
+                with self._lock:
+                    if url in self._pages or url in self._prefetching:
+                        continue
+                    self._prefetching[url] = self._executor.submit(self._prefetch_page, Link(url), finder.session)
+        log.debug('Prefetching the index pages of %s projects', len(project_names))
+
+    def _stop_prefetching(self):
+        self._pending = []
+        with self._lock:
+            prefetching = list(self._prefetching.values())
+            self._prefetching.clear()
+        for future in prefetching:
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            thread_sessions, self._thread_sessions = self._thread_sessions, []
+        for session in thread_sessions:
+            session.close()
+        self._local = threading.local()
+
+    def clear_pages(self):
+        '''
+        Forget the fetched index pages, so that new releases get picked up by long lived processes
+        '''
+        self._stop_prefetching()
+        self._pages.clear()
+
+    def get_mocks(self):
+        state = self
+
+        def _build_session(command, options, retries=None, timeout=None):
+            return state.build_session(command, options, retries=retries, timeout=timeout)
+
+        def find_all_candidates(finder, project_name):
+            return state.find_all_candidates(finder, project_name)
+
+        yield mock.patch('pip._internal.cli.base_command.Command._build_session', new=_build_session)
+        yield mock.patch('pip._internal.index._get_html_page', new=self.get_html_page)
+        yield mock.patch('pip._internal.index.PackageFinder.find_all_candidates', new=find_all_candidates)
+
+    def __enter__(self):
+        import pip._internal.index
+        import pip._internal.cli.base_command
+        self._real_get_html_page = pip._internal.index._get_html_page
+        self._real_build_session = pip._internal.cli.base_command.Command._build_session
+        self._real_find_all_candidates = pip._internal.index.PackageFinder.find_all_candidates
+        self.start_patches()
+        self._previous = SharedIndexState.current
+        SharedIndexState.current = self
+        return self
+
+    def __exit__(self, *args):
+        SharedIndexState.current = self._previous
+        self._previous = None
+        self._stop_prefetching()
+        self.stop_patches(*args)
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+        self._session_args.clear()
+        self._pages.clear()
+
+
+class CachedLinks(object):
+    '''
+    Replacement for ``HTMLPage.iter_links`` which only parses the page once
+    '''
+
+    __slots__ = ('_iter_links', '_links')
+
+    def __init__(self, iter_links):
+        self._iter_links = iter_links
+        self._links = None
+
+    def __call__(self):
+        if self._links is None:
+            self._links = list(self._iter_links())
+        return iter(self._links)
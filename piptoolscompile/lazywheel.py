@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.lazywheel
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Read remote wheels through HTTP range requests, instead of downloading them.
+
+    A wheel is a zip archive, whose central directory, listing the members and where each one of
+    them starts, sits at its very end, and whose ``*.dist-info`` members usually come last.
+    ``LazyRemoteFile`` is a seekable, read only, file object which only downloads the parts of the
+    remote file which get read, at least a chunk at a time. Reading a wheel's ``METADATA`` through
+    ``zipfile`` ends up fetching its last chunk, and, for large wheels, the central directory and
+    ``METADATA`` member, when they are not part of it.
+
+    Servers which do not honour range requests answer with the whole file, in which case
+    ``RangeRequestsNotSupported`` gets raised, without downloading it.
+'''
+
+# Import Python Libs
+import io
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+# The minimum amount of bytes fetched per request
+CHUNK_SIZE = 64 * 1024
+CONTENT_RANGE_RE = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<size>\d+)$')
+
+
+class RangeRequestsNotSupported(IOError):
+    '''
+    Raised when the server answers a range request with anything but the requested range
+    '''
+
+
+class LazyRemoteFile(io.RawIOBase):
+    '''
+    Read only file object over the remote file at ``url``, downloaded in ranges, as it gets read,
+    through the requests ``session``
+    '''
+
+    def __init__(self, session, url, chunk_size=CHUNK_SIZE):
+        super(LazyRemoteFile, self).__init__()
+        self._session = session
+        self._url = url
+        self._chunk_size = chunk_size
+        self._pos = 0
+        # The (start, data) ranges fetched so far
+        self._ranges = []
+        self.requests = 0
+        # The last chunk, fetched right away, also tells the size of the file
+        start, data, self._size = self._fetch('bytes=-{}'.format(chunk_size))
+        self._ranges.append((start, data))
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def fetched(self):
+        return sum(len(data) for _, data in self._ranges)
+
+    def _fetch(self, byte_range):
+        response = self._session.get(
+            self._url,
+            headers={'Range': byte_range, 'Accept-Encoding': 'identity'},
+            stream=True,
+        )
+        try:
+            response.raise_for_status()
+            match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+            if response.status_code != 206 or match is None:
+                raise RangeRequestsNotSupported(
+                    'The server does not support range requests for {}'.format(self._url)
+                )
+            data = response.content
+        finally:
+            response.close()
+        self.requests += 1
+        start, end, size = (int(match.group(name)) for name in ('start', 'end', 'size'))
+        if len(data) != end - start + 1:
+            raise IOError('Got {} bytes instead of {} from {}'.format(len(data), end - start + 1, self._url))
+        log.debug('Fetched bytes %s-%s/%s of %s', start, end, size, self._url)
+        return start, data, size
+
+    def _read_range(self, start, end):
+        for range_start, data in self._ranges:
+            if range_start <= start and end <= range_start + len(data):
+                return data[start - range_start:end - range_start]
+        fetch_end = min(max(end, start + self._chunk_size), self._size)
+        range_start, data, _ = self._fetch('bytes={}-{}'.format(start, fetch_end - 1))
+        self._ranges.append((range_start, data))
+        return data[start - range_start:end - range_start]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('Invalid whence ({}, should be 0, 1 or 2)'.format(whence))
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self._size
+        else:
+            end = min(self._pos + size, self._size)
+        if end <= self._pos:
+            return b''
+        data = self._read_range(self._pos, end)
+        self._pos = end
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._ranges = []
+        super(LazyRemoteFile, self).close()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.metadata
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Distribution metadata cache shared between all impersonated targets.
+
+    pip-tools caches the dependencies of each pinned requirement per platform and python version,
+    because, by the time they get cached, the environment markers have already been evaluated.
+    A wheel's metadata, however, is the same no matter which target looks at it, so we store the
+    raw metadata, keyed by ``(name, version, wheel filename)``, and evaluate the markers when the
+    dependencies are looked up.
+
+    The metadata of remote wheels missing from the cache gets read through HTTP range requests,
+    see ``piptoolscompile.lazywheel``, instead of downloading the whole wheel, unless the server
+    does not support them.
+
+    Source distributions, whose metadata can depend on the environment running ``setup.py``, get
+    their built metadata cached separately, keyed by ``(name, version, sha256, build environment)``,
+    the build environment being the marker environment of the interpreter running ``setup.py``.
+    pip runs it in a subprocess of its own, which is not impersonated, so every target shares the
+    build, while the environment markers of the built requirements get evaluated per target.
+
+    Both are stored, entry by entry, in the dependency cache database, see ``piptoolscompile.depcache``,
+    which evicts the least recently used ones along with the dependency cache entries.
+'''
+
+# Import Python Libs
+import os
+import json
+import hashlib
+import logging
+import zipfile
+import email.parser
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+import piptoolscompile.timings
+
+log = logging.getLogger(__name__)
+
+# The metadata headers which are needed to compute the dependencies of a distribution
+METADATA_HEADERS = ('Name', 'Version', 'Requires-Python', 'Requires-Dist', 'Provides-Extra')
+
+
+def read_wheel_metadata(path):
+    '''
+    Return the trimmed down ``METADATA`` contents of the wheel at ``path``, a path or a file
+    object, or ``None`` if it cannot be read.
+    '''
+    try:
+        with zipfile.ZipFile(path) as zfh:
+            for name in zfh.namelist():
+                parts = name.split('/')
+                if len(parts) == 2 and parts[0].endswith('.dist-info') and parts[1] == 'METADATA':
+                    return trim_metadata(zfh.read(name).decode('utf-8'))
+    except (IOError, OSError, zipfile.BadZipfile, UnicodeDecodeError) as exc:
+        log.debug('Failed to read the metadata from %s: %s', path, exc)
+    return None
+
+
+def trim_metadata(contents):
+    parsed = email.parser.Parser().parsestr(contents, headersonly=True)
+    lines = []
+    for header in METADATA_HEADERS:
+        for value in parsed.get_all(header) or []:
+            lines.append('{}: {}'.format(header, value))
+    return '\n'.join(lines) + '\n'
+
+
+def read_dist_metadata(dist):
+    '''
+    Return the trimmed down metadata files of the built distribution ``dist``, by name, or ``None``
+    if it has none
+    '''
+    from pip._vendor import pkg_resources
+
+    if isinstance(dist, pkg_resources.DistInfoDistribution) and dist.has_metadata('METADATA'):
+        return {'METADATA': trim_metadata(dist.get_metadata('METADATA'))}
+    if not dist.has_metadata('PKG-INFO'):
+        return None
+    files = {'PKG-INFO': trim_metadata(dist.get_metadata('PKG-INFO'))}
+    if dist.has_metadata('requires.txt'):
+        # Still holding the environment markers, as [extra:marker] sections
+        files['requires.txt'] = dist.get_metadata('requires.txt')
+    return files
+
+
+def get_build_environment():
+    '''
+    Return a digest of the marker environment of the interpreter running ``setup.py``, this one,
+    which must not be impersonated
+    '''
+    from pip._vendor.packaging.markers import default_environment
+    environment = json.dumps(default_environment(), sort_keys=True)
+    return hashlib.sha256(environment.encode('utf-8')).hexdigest()[:16]
+
+
+def get_artifact_digest(repository, link):
+    '''
+    Return the sha256 hex digest of the ``link`` artifact, or ``None`` if the index does not provide
+    it and it was not downloaded yet
+    '''
+    if link.hash_name == 'sha256':
+        return link.hash
+    if link.scheme == 'file':
+        from pip._internal.download import url_to_path
+        path = url_to_path(link.url_without_fragment)
+    else:
+        path = os.path.join(repository._download_dir, link.filename)
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as rfh:
+            for chunk in iter(lambda: rfh.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+class MetadataCache(object):
+    '''
+    ``(name, version, artifact) -> metadata`` mapping, stored under ``namespace`` in the dependency
+    cache database of ``cache_dir``, or only kept in memory when the sqlite3 module is not available
+    '''
+
+    def __init__(self, cache_dir, namespace='wheel-metadata'):
+        self._cache_dir = cache_dir
+        self._namespace = namespace
+        self._cache = {}
+        self._connection = None
+
+    @property
+    def connection(self):
+        import piptoolscompile.depcache
+        if self._connection is None and piptoolscompile.depcache.sqlite3 is not None:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir, exist_ok=True)
+            self._connection = piptoolscompile.depcache.connect(
+                os.path.join(self._cache_dir, piptoolscompile.depcache.DEPCACHE_DATABASE)
+            )
+        return self._connection
+
+    def get(self, name, version, artifact):
+        import piptoolscompile.depcache
+        key = (name, '{}/{}'.format(version, artifact))
+        if key not in self._cache and self.connection is not None:
+            metadata = piptoolscompile.depcache.read_entry(self.connection, self._namespace, *key)
+            if metadata is not None:
+                self._cache[key] = metadata
+        return self._cache.get(key)
+
+    def set(self, name, version, artifact, metadata):
+        import piptoolscompile.depcache
+        key = (name, '{}/{}'.format(version, artifact))
+        self._cache[key] = metadata
+        if self.connection is not None:
+            piptoolscompile.depcache.write_entry(self.connection, self._namespace, *(key + (metadata,)))
+
+
+class InMemoryMetadata(object):
+    '''
+    Minimal ``pkg_resources`` metadata provider serving the cached metadata ``files``, by name
+    '''
+
+    def __init__(self, files):
+        self._files = files
+
+    def has_metadata(self, name):
+        return name in self._files
+
+    def get_metadata(self, name):
+        return self._files[name]
+
+    def get_metadata_lines(self, name):
+        from pip._vendor import pkg_resources
+        return pkg_resources.yield_lines(self.get_metadata(name))
+
+
+def dependencies_from_metadata(ireq, metadata):
+    '''
+    Compute the dependencies of ``ireq`` from its cached wheel ``METADATA``, for the currently
+    impersonated target
+    '''
+    from pip._vendor import pkg_resources
+
+    dist = pkg_resources.DistInfoDistribution(
+        project_name=ireq.name,
+        metadata=InMemoryMetadata({'METADATA': metadata}),
+    )
+    return dependencies_from_dist(ireq, dist)
+
+
+def dependencies_from_built_metadata(ireq, files):
+    '''
+    Compute the dependencies of ``ireq`` from the cached metadata ``files`` of its built source
+    distribution, for the currently impersonated target
+    '''
+    from pip._vendor import pkg_resources
+
+    if 'METADATA' in files:
+        return dependencies_from_metadata(ireq, files['METADATA'])
+    dist = pkg_resources.Distribution(project_name=ireq.name, metadata=InMemoryMetadata(files))
+    return dependencies_from_dist(ireq, dist)
+
+
+def dependencies_from_dist(ireq, dist):
+    '''
+    Compute the dependencies of ``ireq`` from ``dist``, for the currently impersonated target, the
+    same way ``pip._internal.resolve.Resolver._resolve_one`` does.
+    '''
+    from pip._internal.req.req_set import RequirementSet
+    from pip._internal.req.constructors import install_req_from_req_string
+    from pip._internal.utils.packaging import check_dist_requires_python
+
+    check_dist_requires_python(dist)
+
+    requirement_set = RequirementSet()
+    req_to_install = install_req_from_req_string(str(ireq.req))
+    req_to_install.markers = ireq.markers
+    req_to_install.is_direct = True
+    requirement_set.add_requirement(req_to_install, parent_req_name=None)
+
+    more_reqs = []
+    available_requested = sorted(set(dist.extras) & set(ireq.extras))
+    for subreq in dist.requires(available_requested):
+        sub_install_req = install_req_from_req_string(str(subreq), req_to_install)
+        to_scan_again, _ = requirement_set.add_requirement(
+            sub_install_req,
+            parent_req_name=req_to_install.name,
+            extras_requested=available_requested,
+        )
+        more_reqs.extend(to_scan_again)
+    return set(more_reqs)
+
+
+class SharedMetadata(piptoolscompile.utils.PatchingMixin):
+    '''
+    Serve ``PyPIRepository.get_dependencies`` from the shared metadata cache whenever the artifact
+    pip would pick for the impersonated target is a wheel, and from the built metadata cache when
+    it is a source distribution which was already built.
+    '''
+
+    def __init__(self):
+        self._caches = {}
+        self._built_caches = {}
+        self._patches = []
+        self._real_get_dependencies = None
+        self._real_get_abstract_dist_for = None
+        self._build_environment = None
+        # The metadata of the source distributions built while it's a list
+        self._built = None
+        self.hits = self.misses = 0
+        self.built_hits = self.built_misses = 0
+
+    def get_cache(self, cache_dir):
+        if cache_dir not in self._caches:
+            self._caches[cache_dir] = MetadataCache(cache_dir)
+        return self._caches[cache_dir]
+
+    def get_built_cache(self, cache_dir):
+        if cache_dir not in self._built_caches:
+            self._built_caches[cache_dir] = MetadataCache(cache_dir, 'sdist-metadata')
+        return self._built_caches[cache_dir]
+
+    def get_dependencies(self, repository, ireq):
+        from pip._vendor.packaging.utils import canonicalize_name
+        from piptools.utils import as_tuple, is_pinned_requirement, is_url_requirement
+
+        if (ireq.editable
+                or is_url_requirement(ireq)
+                or not is_pinned_requirement(ireq)
+                or ireq in repository._dependencies_cache):
+            return self._real_get_dependencies(repository, ireq)
+
+        try:
+            link = repository.finder.find_requirement(ireq, upgrade=False)
+        except Exception as exc:  # pylint: disable=broad-except
+            # Let pip's own code path report the error
+            log.debug('Failed to find the artifact for %s: %s', ireq, exc)
+            link = None
+        if link is not None and not link.is_wheel and link.is_artifact:
+            return self.get_sdist_dependencies(repository, ireq, link)
+        if link is None or not link.is_wheel:
+            return self._real_get_dependencies(repository, ireq)
+
+        cache = self.get_cache(repository._cache_dir)
+        _, version, _ = as_tuple(ireq)
+        key = (canonicalize_name(ireq.name), version, link.filename)
+        metadata = cache.get(*key)
+        if metadata is not None:
+            self.hits += 1
+            piptoolscompile.timings.count('shared_metadata_hits')
+            log.debug('Computing the dependencies of %s from the shared metadata of %s', ireq, link.filename)
+            dependencies = dependencies_from_metadata(ireq, metadata)
+            repository._dependencies_cache[ireq] = dependencies
+            return dependencies
+
+        self.misses += 1
+        piptoolscompile.timings.count('shared_metadata_misses')
+        if link.scheme in ('http', 'https'):
+            metadata = self.fetch_remote_metadata(repository.session, link)
+            if metadata is not None:
+                log.debug('Storing the metadata of %s in the shared metadata cache', link.filename)
+                cache.set(*(key + (metadata,)))
+                dependencies = dependencies_from_metadata(ireq, metadata)
+                repository._dependencies_cache[ireq] = dependencies
+                return dependencies
+        dependencies = self._real_get_dependencies(repository, ireq)
+        if link.scheme == 'file':
+            from pip._internal.download import url_to_path
+            wheel_path = url_to_path(link.url_without_fragment)
+        else:
+            wheel_path = os.path.join(repository._wheel_download_dir, link.filename)
+        metadata = read_wheel_metadata(wheel_path)
+        if metadata is not None:
+            log.debug('Storing the metadata of %s in the shared metadata cache', link.filename)
+            cache.set(*(key + (metadata,)))
+        return dependencies
+
+    def get_sdist_dependencies(self, repository, ireq, link):
+        '''
+        Serve the dependencies of ``ireq``, whose ``link`` is a source distribution, from its built
+        metadata, building it, and caching it, when it was not built in the same environment yet
+        '''
+        from pip._vendor.packaging.utils import canonicalize_name
+        from piptools.utils import as_tuple
+
+        cache = self.get_built_cache(repository._cache_dir)
+        _, version, _ = as_tuple(ireq)
+        name = canonicalize_name(ireq.name)
+        digest = get_artifact_digest(repository, link)
+        if digest is not None:
+            files = cache.get(name, version, '{}-{}'.format(digest, self._build_environment))
+            if files is not None:
+                self.built_hits += 1
+                piptoolscompile.timings.count('sdist_metadata_hits')
+                log.debug('Computing the dependencies of %s from the built metadata of %s', ireq, link.filename)
+                dependencies = dependencies_from_built_metadata(ireq, files)
+                repository._dependencies_cache[ireq] = dependencies
+                return dependencies
+
+        self.built_misses += 1
+        piptoolscompile.timings.count('sdist_metadata_misses')
+        self._built = []
+        try:
+            dependencies = self._real_get_dependencies(repository, ireq)
+            built = self._built
+        finally:
+            self._built = None
+        if digest is None:
+            # Downloaded by now
+            digest = get_artifact_digest(repository, link)
+        if len(built) == 1 and built[0] is not None and digest is not None:
+            log.debug('Storing the built metadata of %s in the built metadata cache', link.filename)
+            cache.set(name, version, '{}-{}'.format(digest, self._build_environment), built[0])
+        return dependencies
+
+    def get_abstract_dist_for(self, resolver, req):
+        abstract_dist = self._real_get_abstract_dist_for(resolver, req)
+        if self._built is not None:
+            from pip._internal.operations.prepare import IsSDist
+            if isinstance(abstract_dist, IsSDist):
+                self._built.append(read_dist_metadata(abstract_dist.dist()))
+        return abstract_dist
+
+    def fetch_remote_metadata(self, session, link):
+        '''
+        Return the trimmed down ``METADATA`` contents of the remote wheel ``link``, read through HTTP
+        range requests, or ``None`` if it has to be downloaded
+        '''
+        import piptoolscompile.lazywheel
+
+        try:
+            with piptoolscompile.timings.phase('lazy_wheel_metadata'):
+                with piptoolscompile.lazywheel.LazyRemoteFile(session, link.url_without_fragment) as rfh:
+                    metadata = read_wheel_metadata(rfh)
+                    fetched, size = rfh.fetched, rfh.size
+        except (IOError, OSError) as exc:
+            log.debug('Not reading the metadata of %s through range requests: %s', link.filename, exc)
+            metadata = None
+        if metadata is None:
+            piptoolscompile.timings.count('lazy_wheel_fallbacks')
+            return None
+        piptoolscompile.timings.count('lazy_wheel_hits')
+        piptoolscompile.timings.count('lazy_wheel_bytes_saved', size - fetched)
+        log.debug('Read the metadata of %s out of %s of its %s bytes', link.filename, fetched, size)
+        return metadata
+
+    def get_mocks(self):
+        state = self
+
+        def get_dependencies(repository, ireq):
+            with piptoolscompile.timings.phase('metadata_extraction'):
+                return state.get_dependencies(repository, ireq)
+
+        def _get_abstract_dist_for(resolver, req):
+            return state.get_abstract_dist_for(resolver, req)
+
+        yield mock.patch('piptools.repositories.pypi.PyPIRepository.get_dependencies', new=get_dependencies)
+        yield mock.patch('pip._internal.resolve.Resolver._get_abstract_dist_for', new=_get_abstract_dist_for)
+
+    def __enter__(self):
+        import piptools.repositories.pypi
+        import pip._internal.resolve
+        self._real_get_dependencies = piptools.repositories.pypi.PyPIRepository.get_dependencies
+        self._real_get_abstract_dist_for = pip._internal.resolve.Resolver._get_abstract_dist_for
+        # Entered before any impersonation
+        self._build_environment = get_build_environment()
+        self.start_patches()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_patches(*args)
+        log.debug('Shared metadata cache hits: %s, misses: %s', self.hits, self.misses)
+        log.debug('Built metadata cache hits: %s, misses: %s', self.built_hits, self.built_misses)
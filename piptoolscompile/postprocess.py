@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.postprocess
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Post-process the compiled requirements in a single streaming pass.
+
+    Each line of the compiled file goes through a chain of line transforms, and whatever comes out
+    of the last one gets written to a temporary file which then atomically replaces the compiled
+    file, unless their contents are the same, in which case the compiled file, and its modification
+    time, are left alone. A line transform can replace a line with any number of lines, and append lines once the
+    whole file went through it, those going through the remaining transforms of the chain.
+
+    Extra line transforms can be plugged in with ``register_line_transform``.
+'''
+
+# Import Python Libs
+import os
+import re
+import filecmp
+import logging
+import textwrap
+import warnings
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+
+log = logging.getLogger(__name__)
+
+# Callables returning a line transform, or ``None``, for ``(fpath, options)``
+_LINE_TRANSFORM_FACTORIES = []
+
+
+def register_line_transform(factory):
+    '''
+    Register ``factory``, a callable taking the requirements file being compiled and the target
+    options, and returning a ``LineTransform``, or ``None`` when it does not apply.
+
+    The registered transforms run in the order they were registered, after the built-in ones and
+    before the fingerprint gets set.
+    '''
+    _LINE_TRANSFORM_FACTORIES.append(factory)
+    return factory
+
+
+def get_registered_line_transforms(fpath, options):
+    transforms = []
+    for factory in _LINE_TRANSFORM_FACTORIES:
+        transform = factory(fpath, options)
+        if transform is not None:
+            transforms.append(transform)
+    return transforms
+
+
+class LineTransform(object):
+    '''
+    Base line transform, passes every line through unchanged
+    '''
+
+    def transform(self, line):
+        '''
+        Return the lines, without line endings, replacing ``line``
+        '''
+        return (line,)
+
+    def finish(self):
+        '''
+        Return the lines to append once the whole file went through this transform
+        '''
+        return ()
+
+
+class ReplaceText(LineTransform):
+    '''
+    Replace every occurrence of each of the ``replacements`` keys with its value
+    '''
+
+    def __init__(self, replacements):
+        self._replacements = replacements
+
+    def transform(self, line):
+        for old, new in self._replacements.items():
+            if old in line:
+                line = line.replace(old, new)
+        return (line,)
+
+
+class AppendPassthroughLines(LineTransform):
+    '''
+    Append the lines taken out of the included requirement files
+    '''
+
+    def __init__(self, passthrough_lines):
+        self._passthrough_lines = passthrough_lines
+
+    def finish(self):
+        lines = []
+        for input_file, passthrough_lines in self._passthrough_lines.items():
+            lines.append('# Passthrough dependencies from {}'.format(input_file))
+            lines.extend(passthrough_lines)
+        return lines
+
+
+class RemoveLines(LineTransform):
+    '''
+    Comment out the lines matching any of the ``regexes``
+    '''
+
+    # Back references, whose numbering changes when patterns get combined
+    BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self, regexes, script_name):
+        self._regexes = regexes
+        self._script_name = script_name
+        self._matcher = self.combine(regexes)
+
+    @classmethod
+    def combine(cls, regexes):
+        '''
+        Return a single regex matching whatever any of ``regexes`` matches, or ``None`` when they
+        cannot be safely combined
+        '''
+        if len(regexes) < 2:
+            return None
+        if any(cls.BACKREFERENCE_RE.search(regex.pattern) for regex in regexes):
+            return None
+        flags = {regex.flags for regex in regexes}
+        if len(flags) > 1:
+            return None
+        try:
+            with warnings.catch_warnings():
+                # Inline global flags would apply to every pattern
+                warnings.simplefilter('error')
+                return re.compile('|'.join('(?:{})'.format(regex.pattern) for regex in regexes), flags.pop())
+        except (re.error, DeprecationWarning, FutureWarning):
+            return None
+
+    def transform(self, line):
+        if self._matcher is not None and not self._matcher.match(line):
+            return (line,)
+        for regex in self._regexes:
+            if regex.match(line):
+                print("Line commented out by regex '{}': '{}'".format(regex.pattern, line))
+                return textwrap.dedent('''\
+                    # Next line explicitly commented out by {} because of the following regex: '{}'
+                    # {}'''.format(
+                        self._script_name,
+                        regex.pattern,
+                        line
+                    )
+                ).splitlines()
+        return (line,)
+
+
+class SetFingerprint(LineTransform):
+    '''
+    Set the fingerprint as the last line of the leading comments block
+    '''
+
+    def __init__(self, prefix, fingerprint):
+        self._line = '{}{}'.format(prefix, fingerprint)
+        self._prefix = prefix
+        self._written = False
+
+    def transform(self, line):
+        if line.startswith(self._prefix):
+            return ()
+        if self._written or line.startswith('#'):
+            return (line,)
+        self._written = True
+        return (self._line, line)
+
+    def finish(self):
+        if self._written:
+            return ()
+        self._written = True
+        return (self._line,)
+
+
+def _apply(transforms, lines):
+    '''
+    Run ``lines`` through ``transforms`` in order
+    '''
+    for transform in transforms:
+        transformed = []
+        for line in lines:
+            transformed.extend(transform.transform(line))
+        lines = transformed
+        if not lines:
+            break
+    return lines
+
+
+def postprocess(path, transforms, dest=None):
+    '''
+    Stream the lines of ``path`` through ``transforms`` and write the result to ``dest``, which
+    defaults to ``path``, atomically. Returns whether ``dest`` changed.
+    '''
+    dest = dest or path
+    with piptoolscompile.utils.atomic_path(dest) as temp_path:
+        with open(temp_path, 'w') as wfh, open(path) as rfh:
+            for line in rfh:
+                for out_line in _apply(transforms, [line.rstrip('\r\n')]):
+                    wfh.write(out_line + '\n')
+            for idx, transform in enumerate(transforms):
+                # The appended lines go through the remaining transforms
+                for out_line in _apply(transforms[idx + 1:], list(transform.finish())):
+                    wfh.write(out_line + '\n')
+        if os.path.exists(dest) and filecmp.cmp(temp_path, dest, shallow=False):
+            log.debug('%s is unchanged', dest)
+            # Leave dest, and its modification time, untouched
+            os.unlink(temp_path)
+            return False
+    return True
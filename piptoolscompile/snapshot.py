@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.snapshot
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Record every HTTP response pip gets while compiling, index pages and artifacts alike, into a
+    snapshot archive, and replay them later on without any network access.
+
+    Responses are captured at the transport adapter level, below pip's HTTP cache, so they are
+    replayed exactly as they were received, and nothing in the snapshot depends on the impersonated
+    platform or python version. The archive is a zip file holding a ``snapshot.json`` index, mapping
+    ``"<METHOD> <URL>"``, followed by the requested ``Range``, if any, to the status, headers and
+    body digest of the response, and each distinct body once, as ``blobs/<sha256>``.
+
+    While recording, responses get written to a staging directory as they are received, worker
+    processes included, and packed into the archive once the run is over. Both modes compile with
+    an empty pip-tools cache directory of their own, so that every lookup goes through pip and none
+    gets served from a cache the other side does not have.
+'''
+
+# Import Python Libs
+import os
+import io
+import json
+import shutil
+import zipfile
+import hashlib
+import logging
+import tempfile
+import threading
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_INDEX = 'snapshot.json'
+SNAPSHOT_FORMAT = 1
+
+
+def get_key(request):
+    key = '{} {}'.format(request.method, request.url)
+    if request.headers.get('Range'):
+        # Range requests for the same URL get different responses
+        key += ' Range: {}'.format(request.headers['Range'])
+    return key
+
+
+def build_raw_response(body, headers, status, reason):
+    from pip._vendor.urllib3.response import HTTPResponse
+    from pip._vendor.urllib3._collections import HTTPHeaderDict
+    return HTTPResponse(
+        body=io.BytesIO(body),
+        headers=HTTPHeaderDict(headers),
+        status=status,
+        reason=reason,
+        preload_content=False,
+        decode_content=False,
+    )
+
+
+class SnapshotAdapter(object):
+    '''
+    Transport adapter standing in front of the one pip would have used for a request
+    '''
+
+    def __init__(self, snapshot, adapter):
+        self._snapshot = snapshot
+        self._adapter = adapter
+
+    def send(self, request, **kwargs):
+        return self._snapshot.send(self._adapter, request, **kwargs)
+
+    def close(self):
+        self._adapter.close()
+
+
+class Snapshot(piptoolscompile.utils.PatchingMixin):
+    '''
+    Base class of the record and replay modes, patching pip's sessions while active
+    '''
+
+    # The snapshot of the current run
+    current = None
+
+    def __init__(self, path, cache_dir):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._previous = None
+        self._patches = []
+
+    @property
+    def spec(self):
+        '''
+        What a worker process needs to get into the same mode, see ``activate``
+        '''
+        return (self.__class__.__name__, self.path, self.cache_dir)
+
+    def send(self, adapter, request, **kwargs):
+        raise NotImplementedError
+
+    def get_mocks(self):
+        import pip._internal.download
+        snapshot = self
+        real_get_adapter = pip._internal.download.PipSession.get_adapter
+
+        def get_adapter(session, url):
+            adapter = real_get_adapter(session, url)
+            if url.lower().startswith('file:'):
+                # Local files are not part of the snapshot
+                return adapter
+            return SnapshotAdapter(snapshot, adapter)
+
+        yield mock.patch('pip._internal.download.PipSession.get_adapter', new=get_adapter)
+
+    def __enter__(self):
+        self.start_patches()
+        self._previous = Snapshot.current
+        Snapshot.current = self
+        return self
+
+    def __exit__(self, *args):
+        Snapshot.current = self._previous
+        self._previous = None
+        self.stop_patches(*args)
+
+
+class RecordSnapshot(Snapshot):
+    '''
+    Record the responses into the ``path`` archive
+    '''
+
+    def __init__(self, path, staging_dir=None):
+        if staging_dir is None:
+            staging_dir = tempfile.mkdtemp(prefix='pip-tools-compile-snapshot-')
+        self._staging_dir = staging_dir
+        super(RecordSnapshot, self).__init__(path, os.path.join(staging_dir, 'cache'))
+        self._entries_file = None
+        self._entries_pid = None
+        # Index pages get prefetched by several threads
+        self._entries_lock = threading.Lock()
+
+    @property
+    def spec(self):
+        return (self.__class__.__name__, self.path, self._staging_dir)
+
+    def store_blob(self, body):
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = os.path.join(self._staging_dir, 'blobs', digest)
+        if not os.path.exists(blob_path):
+            with piptoolscompile.utils.atomic_write(blob_path, 'wb') as wfh:
+                wfh.write(body)
+        return digest
+
+    def send(self, adapter, request, **kwargs):
+        response = adapter.send(request, **kwargs)
+        # The body as it was received, still encoded, to be decoded the same way when replayed
+        body = response.raw.read(decode_content=False)
+        headers = list(response.raw.headers.items())
+        response.raw = build_raw_response(body, headers, response.status_code, response.reason)
+        entry = {
+            'key': get_key(request),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': headers,
+            'blob': self.store_blob(body),
+        }
+        with self._entries_lock:
+            if self._entries_file is None or self._entries_pid != os.getpid():
+                # One file per process, forked worker processes write their own
+                self._entries_pid = os.getpid()
+                self._entries_file = open(
+                    os.path.join(self._staging_dir, 'entries-{}.jsonl'.format(os.getpid())), 'a'
+                )
+            self._entries_file.write(json.dumps(entry) + '\n')
+            self._entries_file.flush()
+        return response
+
+    def __enter__(self):
+        os.makedirs(os.path.join(self._staging_dir, 'blobs'), exist_ok=True)
+        return super(RecordSnapshot, self).__enter__()
+
+    def __exit__(self, *args):
+        super(RecordSnapshot, self).__exit__(*args)
+        if self._entries_file is not None:
+            self._entries_file.close()
+            self._entries_file = None
+
+    def pack(self):
+        '''
+        Pack what got recorded, by this process and its workers, into the snapshot archive
+        '''
+        entries = {}
+        for name in sorted(os.listdir(self._staging_dir)):
+            if not name.startswith('entries-'):
+                continue
+            with open(os.path.join(self._staging_dir, name)) as rfh:
+                for line in rfh:
+                    entry = json.loads(line)
+                    entries[entry.pop('key')] = entry
+        with piptoolscompile.utils.atomic_path(self.path) as temp_path:
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(SNAPSHOT_INDEX, json.dumps(
+                    {'__format__': SNAPSHOT_FORMAT, 'entries': entries}, sort_keys=True
+                ))
+                for digest in sorted({entry['blob'] for entry in entries.values()}):
+                    archive.write(os.path.join(self._staging_dir, 'blobs', digest), 'blobs/{}'.format(digest))
+        print('Recorded {} responses into {}'.format(len(entries), self.path))
+        return entries
+
+    def cleanup(self):
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+
+class ReplaySnapshot(Snapshot):
+    '''
+    Serve the responses recorded in the ``path`` archive, and only those
+    '''
+
+    def __init__(self, path, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='pip-tools-compile-snapshot-')
+        super(ReplaySnapshot, self).__init__(path, cache_dir)
+        self._archive = None
+        self._entries = None
+        self.missing = []
+
+    def load(self):
+        self._archive = zipfile.ZipFile(self.path)
+        try:
+            doc = json.loads(self._archive.read(SNAPSHOT_INDEX).decode('utf-8'))
+        except (KeyError, ValueError):
+            doc = {}
+        if doc.get('__format__') != SNAPSHOT_FORMAT:
+            raise ValueError('{} is not a pip-tools-compile snapshot'.format(self.path))
+        self._entries = doc['entries']
+
+    def validate(self):
+        '''
+        Raise ``ValueError`` when ``path`` is not a snapshot archive
+        '''
+        try:
+            self.load()
+        except (IOError, OSError, zipfile.BadZipfile) as exc:
+            raise ValueError('Cannot read the snapshot {}: {}'.format(self.path, exc))
+        finally:
+            if self._archive is not None:
+                self._archive.close()
+            self._archive = self._entries = None
+
+    def send(self, adapter, request, **kwargs):
+        from pip._vendor import requests
+
+        key = get_key(request)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.missing.append(key)
+            print('Not in the snapshot {}: {}'.format(self.path, key))
+            raise requests.exceptions.ConnectionError(
+                '{} is not in the snapshot {}'.format(key, self.path), request=request
+            )
+        body = self._archive.read('blobs/{}'.format(entry['blob']))
+        raw = build_raw_response(body, entry['headers'], entry['status'], entry['reason'])
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def __enter__(self):
+        if self._entries is None:
+            self.load()
+        return super(ReplaySnapshot, self).__enter__()
+
+    def __exit__(self, *args):
+        super(ReplaySnapshot, self).__exit__(*args)
+        self._archive.close()
+        self._archive = None
+        self._entries = None
+
+    def cleanup(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def activate(spec):
+    '''
+    Get the current process in the snapshot mode described by ``spec``, if it isn't already.
+
+    Worker processes started by forking already are, the others get into it for their lifetime.
+    '''
+    if spec is None:
+        return None
+    current = Snapshot.current
+    if current is not None and current.spec == spec:
+        return current
+    mode, path, directory = spec
+    if mode == RecordSnapshot.__name__:
+        snapshot = RecordSnapshot(path, directory)
+    else:
+        snapshot = ReplaySnapshot(path, directory)
+    return snapshot.__enter__()
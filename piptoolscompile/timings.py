@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.timings
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Per phase durations and counters of a run, written out by ``--timings-json``.
+
+    Durations and counters are added to the compile being recorded, when there is one, to the
+    impersonated target they were passed, or to the run as a whole otherwise. ``phase`` and ``count``
+    do nothing unless a ``Timings`` is active, so they can stay in place for good. Phases nest, a
+    resolver round, for example, includes the index fetches and metadata extraction it triggers.
+
+    While active, pip-tools' resolver rounds and pip's HTTP requests get timed and counted as well.
+'''
+
+# Import Python Libs
+import os
+import time
+import json
+import contextlib
+import logging
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+
+log = logging.getLogger(__name__)
+
+
+def _add(durations, name, duration):
+    durations[name] = durations.get(name, 0.0) + duration
+
+
+@contextlib.contextmanager
+def phase(name, target=None):
+    '''
+    Time the enclosed block as ``name``
+    '''
+    timings = Timings.current
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start, target)
+
+
+@contextlib.contextmanager
+def record(fpath, options):
+    '''
+    Record what happens while compiling ``fpath`` for the target described by ``options``
+    '''
+    timings = Timings.current
+    if timings is None:
+        yield None
+        return
+    with timings.record(fpath, options) as compile_record:
+        yield compile_record
+
+
+def count(name, value=1, target=None):
+    timings = Timings.current
+    if timings is not None:
+        timings.count(name, value, target)
+
+
+class Timings(piptoolscompile.utils.PatchingMixin):
+    '''
+    The durations and counters of the current process, nested ones collecting what happens in
+    a worker process task, without patching anything again
+    '''
+
+    # The timings being collected
+    current = None
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.phases = {}
+        self.counters = {}
+        self.targets = {}
+        self.compiles = []
+        self._compile = None
+        self._previous = None
+        self._patches = []
+        self._start = None
+
+    def add(self, name, duration, target=None):
+        if self._compile is not None:
+            _add(self._compile['phases'], name, duration)
+        elif target is not None:
+            _add(self._get_target(target)['phases'], name, duration)
+        else:
+            _add(self.phases, name, duration)
+
+    def count(self, name, value=1, target=None):
+        if self._compile is not None:
+            counters = self._compile['counters']
+        elif target is not None:
+            counters = self._get_target(target)['counters']
+        else:
+            counters = self.counters
+        counters[name] = counters.get(name, 0) + value
+
+    def _get_target(self, target):
+        return self.targets.setdefault('{}-py{}'.format(*target), {'phases': {}, 'counters': {}})
+
+    @contextlib.contextmanager
+    def record(self, fpath, options):
+        '''
+        Record what happens while compiling ``fpath`` for the target described by ``options``
+        '''
+        compile_record = {
+            'file': fpath,
+            'platform': options.platform,
+            'py_version': options.py_version,
+            'phases': {},
+            'counters': {},
+        }
+        previous = self._compile
+        self._compile = compile_record
+        profiler = None
+        if self.profile_dir is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield compile_record
+        finally:
+            compile_record['duration_s'] = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                if not os.path.isdir(self.profile_dir):
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                compile_record['profile'] = os.path.join(self.profile_dir, '{}-{}-py{}.pstats'.format(
+                    os.path.splitext(os.path.basename(fpath))[0], options.platform, options.py_version
+                ))
+                profiler.dump_stats(compile_record['profile'])
+            self._compile = previous
+            self.compiles.append(compile_record)
+
+    def get_mocks(self):
+        try:
+            from unittest import mock
+        except ImportError:
+            import mock
+        import piptools.resolver
+        import pip._internal.download
+        real_resolve_one_round = piptools.resolver.Resolver._resolve_one_round
+        real_send = pip._internal.download.PipSession.send
+
+        def _resolve_one_round(resolver):
+            count('resolver_rounds')
+            with phase('resolver_round'):
+                return real_resolve_one_round(resolver)
+
+        def send(session, request, **kwargs):
+            with phase('http'):
+                response = real_send(session, request, **kwargs)
+            count('http_requests')
+            if getattr(response, 'from_cache', False):
+                count('http_cache_hits')
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit():
+                count('http_bytes', int(content_length))
+            return response
+
+        yield mock.patch('piptools.resolver.Resolver._resolve_one_round', new=_resolve_one_round)
+        yield mock.patch('pip._internal.download.PipSession.send', new=send)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._previous = Timings.current
+        Timings.current = self
+        if self._previous is None:
+            with phase('import'):
+                # Only imported to time how long importing them takes
+                import piptools.scripts.compile  # noqa pylint: disable=unused-import
+                import piptoolscompile.hacks  # noqa pylint: disable=unused-import
+            self.start_patches()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_patches(*args)
+        Timings.current = self._previous
+        self._previous = None
+        self.phases['total'] = self.phases.get('total', 0.0) + time.perf_counter() - self._start
+
+    def as_dict(self):
+        return {
+            'phases': self.phases,
+            'counters': self.counters,
+            'targets': self.targets,
+            'compiles': self.compiles,
+        }
+
+    def merge(self, other):
+        '''
+        Merge the ``as_dict()`` of the timings collected by a worker process task
+        '''
+        for name, duration in other['phases'].items():
+            if name != 'total':
+                _add(self.phases, name, duration)
+        for name, value in other['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for target, values in other['targets'].items():
+            mine = self.targets.setdefault(target, {'phases': {}, 'counters': {}})
+            for name, duration in values['phases'].items():
+                _add(mine['phases'], name, duration)
+            for name, value in values['counters'].items():
+                mine['counters'][name] = mine['counters'].get(name, 0) + value
+        self.compiles.extend(other['compiles'])
+
+    def write(self, path):
+        dest_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir, exist_ok=True)
+        with open(path, 'w') as wfh:
+            json.dump(self.as_dict(), wfh, indent=2, sort_keys=True)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.universal
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Resolve a requirements file once and project the result onto the remaining targets.
+
+    While the first target gets compiled, every pinned requirement the pip-tools resolver looks at is
+    recorded. For each remaining target we then compute, under its own impersonation, a projection
+    signature made of:
+
+    * the environment markers of the input files, evaluated;
+    * for each best match lookup the resolver made, the version pip would choose;
+    * for each recorded pin, the artifact pip would pick, the evaluation of its ``Requires-Python``
+      and of every environment marker in its ``Requires-Dist`` metadata, for every extra.
+
+    When the signature matches the one of the first target, and the target starts from the same
+    existing pins, the pip-tools resolver would go through exactly the same steps and produce the
+    same output, which then only needs the output file name, in the header, adjusted.
+    Whenever the signature cannot be computed, for example because a pin is only available as a
+    source distribution, whose metadata ``setup.py`` computes at build time, or when it differs,
+    the target is compiled on its own.
+'''
+
+# Import Python Libs
+import os
+import re
+import shlex
+import logging
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Import pip-tools-compile Libs
+import piptoolscompile.utils
+
+log = logging.getLogger(__name__)
+
+PIN_RE = re.compile(r'^(?P<name>[A-Za-z0-9._-]+(\[[^\]]*\])?)==(?P<version>[^\s;#]+)')
+# Evaluating a marker against these extras covers how both pkg_resources and pip evaluate them
+BASE_EXTRAS = (None, '')
+
+
+class ProjectionConflict(Exception):
+    '''
+    Raised when a target's projection signature cannot be computed
+    '''
+
+
+def read_pins(path):
+    '''
+    Return the ``name==version`` pins found in ``path``, or ``None`` if it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    pins = set()
+    with open(path) as rfh:
+        for line in rfh:
+            match = PIN_RE.match(line)
+            if match:
+                pins.add((match.group('name').lower(), match.group('version')))
+    return pins
+
+
+def project_output(source_path, source_dest, dest, transforms=()):
+    '''
+    Write the compiled ``source_path`` as the compiled ``dest``, through the post-processing line ``transforms``.
+    Returns whether ``dest`` changed.
+    '''
+    import piptoolscompile.postprocess
+    from piptoolscompile.cli import FINGERPRINT_PREFIX
+
+    class ProjectHeader(piptoolscompile.postprocess.LineTransform):
+
+        source_option = '--output-file={}'.format(shlex.quote(source_dest))
+        dest_option = '--output-file={}'.format(shlex.quote(dest))
+
+        def transform(self, line):
+            if line.startswith(FINGERPRINT_PREFIX):
+                return ()
+            if line.startswith('#    pip-compile '):
+                line = line.replace(self.source_option, self.dest_option)
+            return (line,)
+
+    return piptoolscompile.postprocess.postprocess(source_path, [ProjectHeader()] + list(transforms), dest=dest)
+
+
+class UniversalResolution(piptoolscompile.utils.PatchingMixin):
+    '''
+    Record the resolution of the first target and compute the projection signatures
+    '''
+
+    def __init__(self, input_files, shared_metadata):
+        self.input_files = input_files
+        self.shared_metadata = shared_metadata
+        self.repository = None
+        self.ireqs = {}
+        self.best_match_lookups = {}
+        self._input_markers = None
+        self._patches = []
+
+    def record_dependencies(self, resolver, ireq):
+        from piptools.utils import as_tuple, is_pinned_requirement
+        repository = resolver.repository
+        # Unwrap the LocalRequirementsRepository proxy
+        self.repository = getattr(repository, 'repository', repository)
+        if ireq.editable or not is_pinned_requirement(ireq):
+            self.ireqs[None] = ireq
+        else:
+            self.ireqs[as_tuple(ireq)] = ireq
+
+    def record_best_match(self, ireq, prereleases):
+        from piptools.utils import key_from_ireq
+        if ireq.editable or ireq.link:
+            self.best_match_lookups[None] = (ireq, prereleases)
+        else:
+            key = (key_from_ireq(ireq), str(ireq.specifier), prereleases)
+            self.best_match_lookups[key] = (ireq, prereleases)
+
+    def get_mocks(self):
+        import piptools.resolver
+        import piptools.repositories.pypi
+        state = self
+        real_iter_dependencies = piptools.resolver.Resolver._iter_dependencies
+        real_find_best_match = piptools.repositories.pypi.PyPIRepository.find_best_match
+
+        def _iter_dependencies(resolver, ireq):
+            state.record_dependencies(resolver, ireq)
+            return real_iter_dependencies(resolver, ireq)
+
+        def find_best_match(repository, ireq, prereleases=None):
+            state.record_best_match(ireq, prereleases)
+            return real_find_best_match(repository, ireq, prereleases=prereleases)
+
+        yield mock.patch('piptools.resolver.Resolver._iter_dependencies', new=_iter_dependencies)
+        yield mock.patch('piptools.repositories.pypi.PyPIRepository.find_best_match', new=find_best_match)
+
+    def get_input_markers(self):
+        if self._input_markers is None:
+            from pip._internal.req.req_file import parse_requirements
+            markers = []
+            for fpath in self.input_files:
+                for ireq in parse_requirements(
+                        fpath,
+                        finder=self.repository.finder,
+                        session=self.repository.session,
+                        options=self.repository.options):
+                    if ireq.markers is not None:
+                        markers.append(ireq.markers)
+            self._input_markers = markers
+        return self._input_markers
+
+    def get_metadata(self, ireq, link):
+        from pip._vendor.packaging.utils import canonicalize_name
+        from piptools.utils import as_tuple
+        cache = self.shared_metadata.get_cache(self.repository._cache_dir)
+        key = (canonicalize_name(ireq.name), as_tuple(ireq)[1], link.filename)
+        metadata = cache.get(*key)
+        if metadata is None:
+            # Populate the shared metadata cache
+            self.shared_metadata.get_dependencies(self.repository, ireq)
+            metadata = cache.get(*key)
+        if metadata is None:
+            raise ProjectionConflict('No metadata available for {}'.format(link.filename))
+        return metadata
+
+    def signature(self):
+        '''
+        Compute the projection signature for the currently impersonated target.
+
+        Must be called in the same environment as the compile, see ``piptoolscompile.cli.compile_environment``.
+        '''
+        import email.parser
+        from pip._vendor.packaging.requirements import Requirement
+        from pip._vendor.packaging.specifiers import InvalidSpecifier
+        from pip._vendor.packaging.utils import canonicalize_name
+        from pip._internal.utils.packaging import check_requires_python
+
+        if self.repository is None or None in self.ireqs or None in self.best_match_lookups:
+            raise ProjectionConflict('Only pinned requirements can be projected')
+
+        # A finder for the currently impersonated target, the valid wheel tags are computed when it's built
+        finder = self.repository.command._build_package_finder(
+            options=self.repository.options,
+            session=self.repository.session,
+        )
+        signature = [
+            ('markers', tuple(marker.evaluate() for marker in self.get_input_markers()))
+        ]
+        candidates = {}
+
+        def get_candidates(name):
+            project = canonicalize_name(name)
+            if project not in candidates:
+                candidates[project] = finder.find_all_candidates(name)
+            return candidates[project]
+
+        for key in sorted(self.best_match_lookups):
+            ireq, prereleases = self.best_match_lookups[key]
+            # The same selection PyPIRepository.find_best_match does
+            all_candidates = get_candidates(ireq.name)
+            matching_versions = set(ireq.specifier.filter(
+                (candidate.version for candidate in all_candidates),
+                prereleases=prereleases
+            ))
+            best = finder.candidate_evaluator.get_best_candidate(
+                [candidate for candidate in all_candidates if candidate.version in matching_versions]
+            )
+            signature.append(('best_match', key, str(best.version) if best is not None else None))
+
+        for key in sorted(self.ireqs):
+            name, version, extras = key
+            ireq = self.ireqs[key]
+            matching = [c for c in get_candidates(name) if str(c.version) == version]
+            best = finder.candidate_evaluator.get_best_candidate(matching)
+            if best is None:
+                raise ProjectionConflict('No candidate found for {}=={}'.format(name, version))
+            link = best.location
+            if not link.is_wheel:
+                raise ProjectionConflict('{} is not a wheel'.format(link.filename))
+            metadata = email.parser.Parser().parsestr(self.get_metadata(ireq, link))
+            provided_extras = tuple(metadata.get_all('Provides-Extra') or ())
+            evaluated = []
+            for requirement in metadata.get_all('Requires-Dist') or ():
+                marker = Requirement(requirement).marker
+                if marker is None:
+                    continue
+                evaluated.append(tuple(
+                    marker.evaluate({'extra': extra}) for extra in BASE_EXTRAS + provided_extras
+                ))
+            try:
+                supports_python = check_requires_python(metadata.get('Requires-Python'))
+            except InvalidSpecifier:
+                supports_python = None
+            signature.append((
+                'pin',
+                key,
+                tuple(sorted(metadata.get_all('Requires-Dist') or ())),
+                provided_extras,
+                supports_python,
+                tuple(evaluated),
+            ))
+        return signature
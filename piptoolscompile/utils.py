@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+    piptoolscompile.utils
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Helpers shared by the whole package, which, unlike ``piptoolscompile.hacks``, do not import pip,
+    so that they can be used before knowing whether there is anything to compile.
+
+    Files which other processes, pip-tools-compile worker processes, concurrent hook runs or the
+    tools reading compiled requirements, might read while they get written, are written next to
+    their final location, then renamed into place, so that nobody ever sees a partially written file.
+'''
+
+# Import Python Libs
+import os
+import shutil
+import logging
+import tempfile
+import contextlib
+
+log = logging.getLogger(__name__)
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once, setting the umask to read it is not thread safe
+UMASK = _get_umask()
+
+
+def make_temp_file(path, suffix='.tmp'):
+    '''
+    Create an empty temporary file next to ``path`` and return its path. It gets the permissions of
+    ``path``, or, if it does not exist, the ones a new file gets, rather than the owner only ones
+    ``mkstemp`` gives it.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)), suffix=suffix)
+    os.close(fd)
+    try:
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else:
+            os.chmod(temp_path, 0o666 & ~UMASK)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    '''
+    Yield the path of a temporary file next to ``path``, which replaces ``path``, atomically, once
+    the block exits without an exception. Removing the temporary file leaves ``path`` untouched.
+    '''
+    temp_path = make_temp_file(path)
+    try:
+        yield temp_path
+        if os.path.exists(temp_path):
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Yield a file, opened with ``mode``, which replaces ``path``, atomically, once the block exits
+    without an exception
+    '''
+    with atomic_path(path) as temp_path:
+        with open(temp_path, mode) as wfh:
+            yield wfh
+
+
+def copy_file_atomically(filename, location, link):
+    '''
+    Replacement for ``pip._internal.download._copy_file`` which is safe when several processes
+    download the same file to the same location, which happens with pip-tools' shared wheels cache.
+
+    The file is copied next to its final location and renamed into place, so no process ever sees
+    a partially copied file, and, if it already exists, another process already downloaded it.
+    '''
+    download_location = os.path.join(location, link.filename)
+    if os.path.exists(download_location):
+        log.debug('%s was already downloaded', download_location)
+        return
+    with atomic_path(download_location) as temp_location:
+        shutil.copy(filename, temp_location)
+    log.info('Saved %s', download_location)
+
+
+class PatchingMixin(object):
+    '''
+    Apply the patches ``get_mocks`` yields when entered, and undo them, in the reverse order, so
+    that targets patched more than once get their original value back, when exited.
+
+    Classes with more to do when entered or exited call ``start_patches`` and ``stop_patches``.
+    '''
+
+    __slots__ = ()
+
+    def get_mocks(self):
+        raise NotImplementedError
+
+    def start_patches(self):
+        for patch in self.get_mocks():
+            patch.__enter__()
+            self._patches.append(patch)
+
+    def stop_patches(self, *args):
+        while self._patches:
+            self._patches.pop().__exit__(*args)
+
+    def __enter__(self):
+        self.start_patches()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_patches(*args)
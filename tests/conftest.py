@@ -7,8 +7,12 @@ conftest
 # Import Python Libs
 import os
 import sys
+import hashlib
 import logging
+import zipfile
+import threading
 import subprocess
+import http.server
 from collections import namedtuple
 
 # Import 3rd-party libs
@@ -36,7 +40,107 @@ class RunCommand(object):
         except subprocess.CalledProcessError as exc:
             return exc.returncode
 
+    def capture(self, *args):
+        '''
+        Run the command like calling it does, but return a ``ProcessResult`` holding its output,
+        with stderr merged into stdout
+        '''
+        cmdline = self.argv + list(args)
+        log.info('Running: %r', ' '.join(cmdline))
+        proc = subprocess.run(
+            cmdline,
+            cwd=REPO_ROOT,
+            env=self.environ,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True
+        )
+        return ProcessResult(proc.returncode, proc.stdout, proc.stderr)
+
 
 @pytest.fixture
 def run_command():
     return RunCommand()
+
+
+def _build_wheel(dest_dir, name, requirements, padding=0):
+    '''
+    Build a ``name`` 1.0 wheel requiring ``requirements``, without code but ``padding`` bytes of
+    data, in ``dest_dir`` and return its path
+    '''
+    dist_info = '{}-1.0.dist-info'.format(name)
+    path = os.path.join(dest_dir, '{}-1.0-py3-none-any.whl'.format(name))
+    metadata = 'Metadata-Version: 2.1\nName: {}\nVersion: 1.0\n'.format(name)
+    metadata += ''.join('Requires-Dist: {}\n'.format(requirement) for requirement in requirements)
+    with zipfile.ZipFile(path, 'w') as wheel:
+        # Incompressible contents, ahead of the metadata, like the modules of a large wheel
+        wheel.writestr('{}/data.bin'.format(name), os.urandom(padding))
+        wheel.writestr('{}/METADATA'.format(dist_info), metadata)
+        wheel.writestr('{}/WHEEL'.format(dist_info), 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n')
+        wheel.writestr('{}/RECORD'.format(dist_info), '')
+    return path
+
+
+@pytest.fixture
+def build_wheel():
+    return _build_wheel
+
+
+class IndexServer(http.server.ThreadingHTTPServer):
+    '''
+    Serve a simple index from ``index_dir`` on a free local port, the handler keeping track of the
+    requests in ``served`` and of the bytes sent in ``sent``. ``wheels`` and ``digests`` hold the
+    path and sha256 of every wheel served
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, index_dir, handler_class, **attributes):
+        super(IndexServer, self).__init__(('127.0.0.1', 0), handler_class)
+        self.index_dir = index_dir
+        self.supports_ranges = True
+        self.served = []
+        self.sent = {}
+        self.wheels = {}
+        self.digests = {}
+        for name, value in attributes.items():
+            setattr(self, name, value)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/simple/'.format(self.server_address[1])
+
+
+@pytest.fixture
+def local_index(tmpdir):
+    '''
+    Start serving, with ``handler_class``, a simple index of wheels built from
+    ``{name: requirements}``, and return the server. The links to the ``hashed`` wheels carry their
+    sha256. The keyword arguments become attributes of the server, for the handler to use. Every
+    server started gets shut down after the test.
+    '''
+    servers = []
+
+    def start(packages, handler_class, padding=None, hashed=(), **attributes):
+        index_dir = tmpdir.join('index')
+        packages_dir = index_dir.ensure('packages', dir=True)
+        server = IndexServer(index_dir.strpath, handler_class, **attributes)
+        for name, requirements in packages.items():
+            path = _build_wheel(packages_dir.strpath, name, requirements, padding=(padding or {}).get(name, 0))
+            with open(path, 'rb') as rfh:
+                server.digests[name] = hashlib.sha256(rfh.read()).hexdigest()
+            fragment = '#sha256={}'.format(server.digests[name]) if name in hashed else ''
+            index_dir.join('simple', name).ensure(dir=True).join('index.html').write(
+                '<a href="../../packages/{0}{1}">{0}</a>\n'.format(os.path.basename(path), fragment)
+            )
+            server.wheels[name] = path
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()